@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+
+"""autocomplete.py
+
+Udacity conference server-side Python App Engine typeahead index over
+conference names, topics and cities, and session names
+
+Each distinct field value is an entry of one AutocompleteShard per word
+it contains, keyed by that word's leading characters and split
+SUB_SHARDS ways by a hash of the entry, and counts how many entities
+carry it. Writes reach the shards through tasks, as (added, removed)
+entries diffed from the entity before and after; each task carries a
+change id that every shard records once it has applied it, so a
+retried task is never counted twice.
+
+Suggestions are not read from the shards. Every prefix of a word, from
+LEAD_LENGTH up to MAX_PREFIX_LENGTH characters, has an AutocompletePrefix
+holding its PREFIX_ENTRIES most common entries, which the same task
+recomputes from the shards of its lead after applying a change. A
+prefix is answered from the one AutocompletePrefix of its longest
+word, so each read is bounded however common the lead, or from the
+instance cache or memcache with no RPC at all.
+
+Shards and prefixes belong to a generation, named by the
+AutocompleteIndex entity. A rebuild scans the datastore into the next
+generation's shards while tasks go on writing to both, fills in its
+prefixes, then makes it current and drops the old one, so suggestions
+are never served from a half-built index.
+
+"""
+
+import hashlib
+import time
+import uuid
+import zlib
+from collections import defaultdict
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from cache import LRUCache
+from instrumentation import transactional
+from models import AutocompleteIndex
+from models import AutocompletePrefix
+from models import AutocompleteShard
+import search
+
+
+FIELDS = {
+    'Conference': ('name', 'topics', 'city'),
+    'Session': ('sessionName',),
+}
+LEAD_LENGTH = 3             # characters a shard is keyed by
+SUB_SHARDS = 4              # shards per lead, by a hash of the entry
+MAX_PREFIX_LENGTH = 8       # longer prefixes are answered from this one's
+PREFIX_ENTRIES = 200        # entries kept per prefix, most common first
+PREFIXES_PER_TXN = 20       # with the lead's shards, within the XG limit
+MAX_VALUE_LENGTH = 200
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = 50
+MEMCACHE_PREFIX = 'AUTOCOMPLETE:'
+CACHE_TTL = 60              # seconds suggestions may lag behind writes
+QUEUE = 'autocomplete'      # its task_age_limit must stay below APPLIED_TTL
+APPLIED_TTL = 2 * 3600      # seconds a shard remembers a change id
+INDEX_TASK_URL = '/tasks/index_autocomplete'
+PREFIX_TASK_URL = '/tasks/fill_autocomplete_prefixes'
+DROP_TASK_URL = '/tasks/drop_autocomplete_generation'
+DROP_DELAY = 2 * CACHE_TTL  # seconds instances may still read the old one
+INDEX_KEY = ndb.Key(AutocompleteIndex, 'autocomplete')
+
+RESULT_CACHE = LRUCache(max_size=2000, default_ttl=CACHE_TTL)
+GENERATION_CACHE = LRUCache(max_size=1, default_ttl=CACHE_TTL)
+
+
+def entriesOf(entity):
+    """Return the set of "field:value" entries an entity contributes."""
+    if entity is None:
+        return set()
+    entries = set()
+    for field in FIELDS[entity._get_kind()]:
+        values = getattr(entity, field, None)
+        for value in (values if isinstance(values, list) else [values]):
+            if value and value.strip():
+                entries.add(u'%s:%s' % (field, value.strip()[:MAX_VALUE_LENGTH]))
+    return entries
+
+
+def _prefixes(entry):
+    """Return the prefixes an entry is suggested for."""
+    value = entry.split(':', 1)[1]
+    return set(token[:length] for token in search.tokenize(value)
+               for length in range(LEAD_LENGTH,
+                                   min(len(token), MAX_PREFIX_LENGTH) + 1))
+
+
+def _leads(entry):
+    """Return the leading characters of the shards an entry belongs in."""
+    return set(prefix[:LEAD_LENGTH] for prefix in _prefixes(entry))
+
+
+def _bucket(entry):
+    return (zlib.crc32(entry.encode('utf-8')) & 0xffffffff) % SUB_SHARDS
+
+
+def _shardKey(generation, lead, bucket):
+    return ndb.Key(AutocompleteShard, u'%d:%s:%d' % (generation, lead, bucket))
+
+
+def _prefixKey(generation, prefix):
+    return ndb.Key(AutocompletePrefix, u'%d:%s' % (generation, prefix))
+
+
+def diff(before, after):
+    """Return (added, removed) entries between two sets of entries."""
+    return sorted(after - before), sorted(before - after)
+
+
+def changes(pairs):
+    """Return (added, removed) entries for (old, new) entity pairs; old
+    is None for new entities.
+    """
+    added, removed = [], []
+    for old, new in pairs:
+        entity_added, entity_removed = diff(entriesOf(old), entriesOf(new))
+        added.extend(entity_added)
+        removed.extend(entity_removed)
+    return added, removed
+
+
+def enqueue(added, removed, transactional=False):
+    """Add a task applying entry changes to the shards, if there are any."""
+    if added or removed:
+        taskqueue.add(url=INDEX_TASK_URL, queue_name=QUEUE,
+            params={'change': uuid.uuid4().hex, 'add': added,
+                    'remove': removed},
+            transactional=transactional)
+
+
+@transactional()
+def _applyToShard(key, change, added, removed):
+    shard = key.get() or AutocompleteShard(key=key)
+    applied = shard.applied or {}
+    if change in applied:
+        return
+    entries = shard.entries or {}
+    for entry in added:
+        entries[entry] = entries.get(entry, 0) + 1
+    for entry in removed:
+        count = entries.get(entry, 0) - 1
+        if count > 0:
+            entries[entry] = count
+        else:
+            entries.pop(entry, None)
+    now = int(time.time())
+    applied = dict((c, t) for c, t in applied.items()
+                   if now - t < APPLIED_TTL)
+    applied[change] = now
+    shard.entries = entries
+    shard.applied = applied
+    shard.put()
+
+
+def _rank((field, value, count)):
+    return -count, value.lower(), field
+
+
+def _topEntries(shards, prefix):
+    """Return the PREFIX_ENTRIES most common [field, value, count] entries
+    of shards with a word starting with prefix.
+    """
+    found = []
+    for shard in shards:
+        for entry, count in (shard.entries if shard else {}).items():
+            field, value = entry.split(':', 1)
+            if any(w.startswith(prefix) for w in search.tokenize(value)):
+                found.append([field, value, count])
+    found.sort(key=_rank)
+    return found[:PREFIX_ENTRIES]
+
+
+@transactional(xg=True)
+def _refreshPrefixes(generation, lead, prefixes):
+    shards = ndb.get_multi([_shardKey(generation, lead, bucket)
+                            for bucket in range(SUB_SHARDS)])
+    tops = [(_prefixKey(generation, prefix), _topEntries(shards, prefix))
+            for prefix in prefixes]
+    ndb.put_multi([AutocompletePrefix(key=key, entries=entries)
+                   for key, entries in tops if entries])
+    ndb.delete_multi([key for key, entries in tops if not entries])
+
+
+def refreshLead(generation, lead, prefixes=None):
+    """Recompute the top entries of a lead's prefixes in a generation;
+    by default of every prefix its shards hold.
+    """
+    if prefixes is None:
+        shards = ndb.get_multi([_shardKey(generation, lead, bucket)
+                                for bucket in range(SUB_SHARDS)])
+        prefixes = set(prefix for shard in shards if shard
+                       for entry in shard.entries or {}
+                       for prefix in _prefixes(entry)
+                       if prefix.startswith(lead))
+    prefixes = sorted(prefixes)
+    for i in range(0, len(prefixes), PREFIXES_PER_TXN):
+        _refreshPrefixes(generation, lead, prefixes[i:i + PREFIXES_PER_TXN])
+
+
+def applyChanges(change, added, removed, generations=None, refresh=True):
+    """Count added entries in, and removed entries out of, their shards
+    in generations; by default the current one and any being rebuilt.
+    Shards that have already applied change are left alone. Unless
+    refresh is false, then recompute the prefixes the entries are
+    suggested for; that is idempotent, so a retry just does it again.
+    """
+    if generations is None:
+        index = INDEX_KEY.get()
+        generations = [index.current, index.building] if index else [0]
+    by_shard = defaultdict(lambda: ([], []))
+    for generation in generations:
+        if generation is None:
+            continue
+        for entry in added:
+            for lead in _leads(entry):
+                by_shard[_shardKey(generation, lead, _bucket(entry))][0] \
+                    .append(entry)
+        for entry in removed:
+            for lead in _leads(entry):
+                by_shard[_shardKey(generation, lead, _bucket(entry))][1] \
+                    .append(entry)
+    for key, (shard_added, shard_removed) in sorted(by_shard.items()):
+        _applyToShard(key, change, shard_added, shard_removed)
+    if not refresh:
+        return
+    by_lead = defaultdict(set)
+    for generation in generations:
+        if generation is None:
+            continue
+        for entry in added + removed:
+            for prefix in _prefixes(entry):
+                by_lead[generation, prefix[:LEAD_LENGTH]].add(prefix)
+    for (generation, lead), prefixes in sorted(by_lead.items()):
+        refreshLead(generation, lead, prefixes)
+
+
+def _currentGeneration():
+    generation = GENERATION_CACHE.get('current')
+    if generation is None:
+        index = INDEX_KEY.get()
+        generation = index.current if index else 0
+        GENERATION_CACHE.set('current', generation)
+    return generation
+
+
+def _matches(value, tokens):
+    """True if every token prefixes some word of value."""
+    words = search.tokenize(value)
+    return all(any(w.startswith(t) for w in words) for t in tokens)
+
+
+def suggest(prefix, limit=DEFAULT_SUGGESTIONS, field=None):
+    """Return up to limit (field, value, count) entries whose words start
+    with the words of prefix, most common first, from the instance
+    cache, memcache or the AutocompletePrefix of its longest word.
+
+    Only that prefix's PREFIX_ENTRIES most common entries are looked at,
+    so a field or further words that rule most of them out can leave
+    fewer than limit suggestions.
+    """
+    tokens = search.tokenize(prefix)
+    longest = max(tokens, key=len) if tokens else ''
+    if len(longest) < LEAD_LENGTH:
+        return []
+    generation = _currentGeneration()
+    cache_key = MEMCACHE_PREFIX + hashlib.sha1((u'%d:%s:%s:%d' % (generation,
+        field or '', ' '.join(sorted(tokens)), limit)).encode('utf-8')).hexdigest()
+    results = RESULT_CACHE.get(cache_key)
+    if results is not None:
+        return results
+    results = memcache.get(cache_key)
+    if results is None:
+        top = _prefixKey(generation, longest[:MAX_PREFIX_LENGTH]).get()
+        results = [(entry_field, value, count)
+                   for entry_field, value, count in (top.entries if top else [])
+                   if (field is None or entry_field == field) and
+                   _matches(value, tokens)][:limit]
+        memcache.set(cache_key, results, time=CACHE_TTL)
+    RESULT_CACHE.set(cache_key, results)
+    return results
+
+
+# - - - Rebuilding - - - - - - - - - - - - - - - - - - - - - -
+
+GENERATION_MODELS = {'AutocompleteShard': AutocompleteShard,
+                     'AutocompletePrefix': AutocompletePrefix}
+
+
+def generationEntities(generation, kind='AutocompleteShard'):
+    """Return a query for a generation's entities of one of
+    GENERATION_MODELS, by key range.
+    """
+    model = GENERATION_MODELS[kind]
+    return model.query(model.key >= ndb.Key(model, u'%d:' % generation),
+                       model.key < ndb.Key(model, u'%d;' % generation))
+
+
+def _scheduleDrop(generation):
+    for kind in sorted(GENERATION_MODELS):
+        taskqueue.add(url=DROP_TASK_URL, queue_name=QUEUE,
+            params={'generation': generation, 'kind': kind},
+            countdown=DROP_DELAY)
+
+
+@transactional()
+def _nextGeneration():
+    index = INDEX_KEY.get() or AutocompleteIndex(key=INDEX_KEY)
+    abandoned = index.building
+    index.building = max(index.current, index.building or 0) + 1
+    index.built = []
+    index.put()
+    return index.building, abandoned
+
+
+def startRebuild():
+    """Start filling a new generation, abandoning any rebuild already
+    under way; returns the backfill params, one per kind to scan.
+    """
+    generation, abandoned = _nextGeneration()
+    if abandoned is not None:
+        _scheduleDrop(abandoned)
+    return [{'kind': kind, 'generation': generation} for kind in sorted(FIELDS)]
+
+
+def rebuildBatch(entities, generation):
+    """Count a batch of scanned entities into the shards of the
+    generation being built; a retried batch is applied once, like a
+    retried task. Its prefixes are filled in once every kind is in.
+    """
+    change = hashlib.sha1('%d:%s' % (generation,
+        ','.join(e.key.urlsafe() for e in entities))).hexdigest()
+    added, removed = changes((None, e) for e in entities)
+    applyChanges(change, added, removed, generations=[generation],
+                 refresh=False)
+
+
+@transactional()
+def _markBuilt(generation, kind):
+    index = INDEX_KEY.get()
+    if not index or index.building != generation or kind in index.built:
+        return
+    index.built.append(kind)
+    index.put()
+    if set(index.built) >= set(FIELDS):
+        taskqueue.add(url=PREFIX_TASK_URL, queue_name=QUEUE,
+            params={'generation': generation}, transactional=True)
+
+
+def finishKind(generation, kind):
+    """Note that kind has been scanned into generation; once every kind
+    has, start filling in the generation's prefixes.
+    """
+    _markBuilt(generation, kind)
+
+
+def fillPrefixes(shard_keys, generation):
+    """Compute the prefixes of the leads of a batch of the generation's
+    shards; a lead split across batches is just computed twice.
+    """
+    for lead in sorted(set(key.id().split(':')[1] for key in shard_keys)):
+        refreshLead(generation, lead)
+
+
+@transactional()
+def _activate(generation):
+    index = INDEX_KEY.get()
+    if not index or index.building != generation:
+        return None
+    old = index.current
+    index.current = generation
+    index.building = None
+    index.built = []
+    index.put()
+    return old
+
+
+def activate(generation):
+    """Serve a generation whose prefixes are filled in, and drop the old
+    one, unless a newer rebuild has abandoned it.
+    """
+    old = _activate(generation)
+    if old is not None:
+        GENERATION_CACHE.clear()
+        _scheduleDrop(old)
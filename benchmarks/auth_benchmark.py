@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""auth_benchmark.py
+
+Compare per-request auth latency of local ID-token verification
+(idtoken.py) against the remote tokeninfo urlfetch path. Tokens are
+signed with a locally generated key pair and the signing keys are
+served by a stub cert endpoint; the tokeninfo stub sleeps for
+--rtt milliseconds to stand in for the network round trip.
+
+    python benchmarks/auth_benchmark.py [--requests N] [--rtt MS]
+
+"""
+
+import argparse
+import base64
+import json
+import time
+
+import common
+common.fix_path()
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+
+class StubResponse(object):
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def _b64int(value):
+    hexed = '%x' % value
+    return _b64(('0' * (len(hexed) % 2) + hexed).decode('hex'))
+
+
+def make_token(key, kid, audience, sub='1234567890'):
+    """Sign an ID token with key the way Google's issuer would."""
+    now = int(time.time())
+    header = _b64(json.dumps({'alg': 'RS256', 'kid': kid, 'typ': 'JWT'}))
+    payload = _b64(json.dumps({
+        'iss': 'accounts.google.com', 'aud': audience, 'sub': sub,
+        'iat': now, 'exp': now + 3600,
+    }))
+    signed = '%s.%s' % (header, payload)
+    signature = PKCS1_v1_5.new(key).sign(SHA256.new(signed))
+    return '%s.%s' % (signed, _b64(signature))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--rtt', type=float, default=40.0,
+                        help='simulated tokeninfo round trip, ms')
+    args = parser.parse_args()
+
+    tb = common.make_testbed()
+    import conference
+    import idtoken
+
+    key = RSA.generate(2048)
+    kid = 'bench-key'
+    jwks = json.dumps({'keys': [{
+        'kty': 'RSA', 'alg': 'RS256', 'use': 'sig', 'kid': kid,
+        'n': _b64int(key.n), 'e': _b64int(key.e),
+    }]})
+    cert_fetches = []
+    rtt = args.rtt / 1000.0
+
+    def cert_endpoint(url):
+        cert_fetches.append(url)
+        return StubResponse(jwks, headers={'Cache-Control': 'max-age=3600'})
+
+    def tokeninfo_endpoint(url, *args, **kwargs):
+        time.sleep(rtt)
+        return StubResponse(json.dumps(
+            {'user_id': '1234567890', 'expires_in': 3600}))
+
+    idtoken.CERTS = idtoken.CertificateCache(fetch=cert_endpoint)
+    conference.urlfetch.fetch = tokeninfo_endpoint
+    token = make_token(key, kid, conference.WEB_CLIENT_ID)
+
+    results = {}
+    for mode in ('tokeninfo', 'local'):
+        conference.VERIFY_ID_TOKENS_LOCALLY = (mode == 'local')
+        samples = []
+        for i in range(args.requests):
+            user, ms = common.timed(conference._verifyToken, token)
+            assert user.get('user_id') == '1234567890', user
+            samples.append(ms)
+        results[mode] = common.percentiles(samples)
+
+    print common.HEADER
+    for mode in ('tokeninfo', 'local'):
+        print common.format_row(mode, results[mode])
+    print 'cert endpoint fetches: %d' % len(cert_fetches)
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
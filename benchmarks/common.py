@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""common.py
+
+Shared setup for the conference benchmark scripts: App Engine SDK path
+fixing, testbed stubs and latency summaries.
+
+Run the scripts from the repository root with the SDK on the path, e.g.
+    GAE_SDK=/path/to/google_appengine python benchmarks/<script>.py
+
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def fix_path():
+    """Put the App Engine SDK and the app itself on sys.path."""
+    sdk = os.environ.get('GAE_SDK')
+    if sdk:
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def make_testbed():
+    """Activate a testbed with the stubs the app uses and return it."""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=ROOT)
+    tb.init_urlfetch_stub()
+    tb.init_app_identity_stub()
+    tb.init_mail_stub()
+    ndb.get_context().clear_cache()
+    return tb
+
+
+def timed(fn, *args, **kwargs):
+    """Call fn and return (result, elapsed milliseconds)."""
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, (time.time() - start) * 1000.0
+
+
+def percentiles(samples):
+    """Summarise a list of millisecond samples."""
+    if not samples:
+        return {'n': 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+    return {
+        'n': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': pct(0.50),
+        'p95': pct(0.95),
+        'p99': pct(0.99),
+        'max': ordered[-1],
+    }
+
+
+def format_row(name, stats):
+    """Format a percentiles() dict as one table row."""
+    if not stats.get('n'):
+        return '%-36s %8s' % (name, 'n/a')
+    return '%-36s %6d %9.3f %9.3f %9.3f %9.3f' % (
+        name, stats['n'], stats['mean'], stats['p50'], stats['p95'],
+        stats['p99'])
+
+
+HEADER = '%-36s %6s %9s %9s %9s %9s' % (
+    'case', 'n', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms')
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""converter_benchmark.py
+
+Micro-benchmark of entity-to-message conversion: the precompiled
+converters in converters.py against the reflective all_fields() copy
+they replaced, on a list of in-memory Conferences and Sessions.
+
+    python benchmarks/converter_benchmark.py [--items N] [--rounds R]
+
+"""
+
+import argparse
+import datetime
+
+import common
+common.fix_path()
+
+
+def reflective_conference_copy(conf, displayName=None):
+    """The original ConferenceApi._copyConferenceToForm."""
+    from models import ConferenceForm
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    if displayName:
+        setattr(cf, 'organizerDisplayName', displayName)
+    cf.check_initialized()
+    return cf
+
+
+def reflective_session_copy(session):
+    """The original ConferenceApi._copySessionToForm."""
+    from models import SessionForm
+    s = SessionForm()
+    for field in s.all_fields():
+        if hasattr(session, field.name):
+            if field.name in ['date', 'startTime']:
+                setattr(s, field.name, str(getattr(session, field.name)))
+            else:
+                setattr(s, field.name, getattr(session, field.name))
+        elif field.name == "websafeSessionKey":
+            setattr(s, field.name, session.key.urlsafe())
+    s.check_initialized()
+    return s
+
+
+def make_entities(n):
+    from google.appengine.ext import ndb
+    from models import Conference, Profile, Session
+
+    confs, sessions = [], []
+    start = datetime.date(2015, 6, 1)
+    for i in range(n):
+        c_key = ndb.Key(Profile, 'organizer', Conference, i + 1)
+        confs.append(Conference(key=c_key, name='Conference %d' % i,
+            description='A conference about things ' * 4,
+            organizerUserId='organizer', topics=['Web', 'Python'],
+            city='London', startDate=start, endDate=start, month=6,
+            maxAttendees=100, seatsAvailable=50))
+        sessions.append(Session(key=ndb.Key(Session, 1, parent=c_key),
+            sessionName='Session %d' % i, highlights='Highlights',
+            speaker='Speaker %d' % (i % 50), duration=1.5,
+            typeOfSession='lecture', date=start,
+            startTime=datetime.time(10, 30), organizerUserId='organizer',
+            conferenceBelongTo='Conference %d' % i))
+    return confs, sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    tb = common.make_testbed()
+    import converters
+    from models import ConferenceForm, SessionForm
+
+    confs, sessions = make_entities(args.items)
+    cases = [
+        ('conferences: reflective', lambda: [
+            reflective_conference_copy(c, 'Organizer') for c in confs]),
+        ('conferences: precompiled', lambda: converters.toForms(
+            confs, ConferenceForm,
+            lambda c: {'organizerDisplayName': 'Organizer'})),
+        ('sessions: reflective', lambda: [
+            reflective_session_copy(s) for s in sessions]),
+        ('sessions: precompiled', lambda: converters.toForms(
+            sessions, SessionForm)),
+    ]
+
+    print '%d items per list, %d rounds' % (args.items, args.rounds)
+    print common.HEADER
+    for name, fn in cases:
+        samples = [common.timed(fn)[1] for i in range(args.rounds)]
+        print common.format_row(name, common.percentiles(samples))
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+"""endpoint_benchmark.py
+
+Drive every ConferenceApi method against seeded testbed stubs and report
+latency percentiles, datastore RPCs and entities read per call. The
+tokeninfo urlfetch behind _getUserId is stubbed, so no network is used;
+tasks are enqueued but not run. Results can be saved as a JSON baseline
+and later runs compared against it.
+
+    python benchmarks/endpoint_benchmark.py [--conferences N] [--calls N]
+        [--save baseline.json] [--compare baseline.json] [--only NAME]
+
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import threading
+from collections import defaultdict
+
+import common
+common.fix_path()
+
+
+class StubResponse(object):
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {}
+
+
+class RpcRecorder(object):
+    """Count API calls per service.call, and entities returned by the
+    datastore, through apiproxy hooks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = defaultdict(int)
+            self.entities = 0
+
+    def pre_call(self, service, call, request, response):
+        with self.lock:
+            self.calls['%s.%s' % (service, call)] += 1
+
+    def post_call(self, service, call, request, response):
+        if service != 'datastore_v3':
+            return
+        if call == 'Get':
+            count = response.entity_size()
+        elif call in ('RunQuery', 'Next'):
+            count = response.result_size()
+        else:
+            return
+        with self.lock:
+            self.entities += count
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy = apiproxy_stub_map.apiproxy
+        apiproxy.GetPreCallHooks().Append('endpoint_benchmark', self.pre_call)
+        apiproxy.GetPostCallHooks().Append('endpoint_benchmark', self.post_call)
+
+
+def seed(args):
+    """Write Profiles, Conferences, Sessions and Wishlists; return ids."""
+    from google.appengine.ext import ndb
+    import autocomplete
+    import conference
+    import feed
+    import search
+    import speakers
+    from models import Profile, Session, Wishlist
+
+    rnd = random.Random(args.seed)
+    cities = ['London', 'Paris', 'Berlin', 'Tokyo', 'Chicago']
+    topics = ['Web', 'Python', 'Cloud', 'Mobile', 'Data']
+    types = ['workshop', 'lecture', 'keynote']
+    speaker_names = ['Speaker %d' % i for i in range(args.speakers)]
+    start = datetime.date(2016, 1, 4)
+
+    user_ids = ['user-%d' % i for i in range(args.profiles)]
+    ndb.put_multi([Profile(id=uid, displayName='User %s' % uid,
+                           mainEmail='%s@example.com' % uid,
+                           teeShirtSize='NOT_SPECIFIED')
+                   for uid in user_ids])
+
+    conferences = []
+    for i in range(args.conferences):
+        organizer = user_ids[i % len(user_ids)]
+        first = start + datetime.timedelta(days=rnd.randint(0, 300))
+        # string ids, so allocated ids of API-created entities can't clash
+        c_key = ndb.Key(Profile, organizer, 'Conference', 'seed-%d' % i)
+        conferences.append(conference._conferenceFromData({
+            'name': 'Conference %d about %s' % (i, rnd.choice(topics)),
+            'description': 'All about %s in %s' % (
+                rnd.choice(topics), rnd.choice(cities)),
+            'organizerUserId': organizer,
+            'topics': rnd.sample(topics, 2),
+            'city': rnd.choice(cities),
+            'startDate': str(first),
+            'endDate': str(first + datetime.timedelta(days=rnd.randint(0, 3))),
+            'maxAttendees': rnd.randint(10, 500),
+        }, c_key))
+    ndb.put_multi(conferences)
+    ndb.put_multi([p for c in conferences for p in search.postingsFor(c)])
+
+    sessions = []
+    for conf in conferences:
+        for j in range(args.sessions):
+            sessions.append(conference._sessionFromData({
+                'sessionName': 'Session %d of %s' % (j, conf.name),
+                'highlights': 'Deep dive into %s' % rnd.choice(topics),
+                'speaker': rnd.choice(speaker_names),
+                'duration': rnd.choice([0.5, 1.0, 1.5]),
+                'typeOfSession': rnd.choice(types),
+                'date': str(conf.startDate),
+                'startTime': '%02d:%02d' % (rnd.randint(8, 20), rnd.choice([0, 30])),
+                'organizerUserId': conf.organizerUserId,
+            }, conf))
+            sessions[-1].key = ndb.Key(Session, 'seed-%d' % j, parent=conf.key)
+    ndb.put_multi(sessions)
+    ndb.put_multi([p for s in sessions for p in search.postingsFor(s)])
+    speakers.indexSessions(sessions)
+    autocomplete.applyChanges('seed', *autocomplete.changes(
+        (None, e) for e in conferences + sessions))
+    for conf in conferences:
+        speakers.recountConference(conf.key)
+
+    wishlists = []
+    for uid in user_ids:
+        for s in rnd.sample(sessions, min(args.wishlists, len(sessions))):
+            wishlists.append(Wishlist(
+                key=conference._wishlistKey(ndb.Key(Profile, uid), s.key),
+                userName=uid, userKey=ndb.Key(Profile, uid),
+                sessionKey=s.key, sessionName=s.sessionName,
+                conferenceKey=s.key.parent()))
+    ndb.put_multi(wishlists)
+    feed.rebuild()
+
+    return {
+        'users': user_ids,
+        'conferences': [c.key.urlsafe() for c in conferences],
+        'organizers': dict((c.key.urlsafe(), c.organizerUserId)
+                           for c in conferences),
+        'sessions': [s.key.urlsafe() for s in sessions],
+        'speakers': speaker_names,
+        'dates': sorted(set(str(c.startDate) for c in conferences)),
+    }
+
+
+def make_cases(data, rnd):
+    """Return [(method name, build)] covering every API method; build(i)
+    returns (acting user id, request field values).
+    """
+    users = data['users']
+    confs = data['conferences']
+    organizers = data['organizers']
+    counter = itertools.count()
+
+    def anyone(fields):
+        return lambda i: (rnd.choice(users), fields(i))
+
+    def organizer(fields):
+        def build(i):
+            wsck = rnd.choice(confs)
+            return organizers[wsck], fields(i, wsck)
+        return build
+
+    def new_session(i):
+        return {'sessionName': 'Bench session %d' % next(counter),
+                'speaker': rnd.choice(data['speakers']),
+                'typeOfSession': 'lecture', 'date': data['dates'][0],
+                'startTime': '10:00', 'duration': 1.0}
+
+    # register and unregister use the same users in turn, so each
+    # unregister undoes a registration
+    registered = []
+
+    def register(i):
+        user, wsck = rnd.choice(users), rnd.choice(confs)
+        registered.append((user, wsck))
+        return user, {'websafeConferenceKey': wsck}
+
+    def unregister(i):
+        user, wsck = registered.pop() if registered else (users[0], confs[0])
+        return user, {'websafeConferenceKey': wsck}
+
+    return [
+        ('getConference', anyone(lambda i: {
+            'websafeConferenceKey': rnd.choice(confs)})),
+        ('queryConferences', anyone(lambda i: {})),
+        ('queryConferences', anyone(lambda i: {'filters': [
+            {'field': 'CITY', 'operator': 'EQ', 'value': 'London'}]})),
+        ('getConferencesCreated', anyone(lambda i: {})),
+        ('getUpcomingConferences', anyone(lambda i: {'pageSize': 50})),
+        ('createConference', anyone(lambda i: {
+            'name': 'Bench conference %d' % next(counter), 'city': 'London',
+            'startDate': data['dates'][0], 'endDate': data['dates'][0],
+            'maxAttendees': 100})),
+        ('updateConference', organizer(lambda i, wsck: {
+            'websafeConferenceKey': wsck, 'description': 'Updated %d' % i})),
+        ('getProfile', anyone(lambda i: {})),
+        ('saveProfile', anyone(lambda i: {'displayName': 'Renamed %d' % i})),
+        ('getAnnouncement', anyone(lambda i: {})),
+        ('putAnnouncement', anyone(lambda i: {})),
+        ('registerForConference', register),
+        ('getConferencesToAttend', anyone(lambda i: {})),
+        ('unregisterFromConference', unregister),
+        ('createSession', organizer(lambda i, wsck: dict(
+            new_session(i), websafeConferenceKey=wsck))),
+        ('createSessions', organizer(lambda i, wsck: {
+            'websafeConferenceKey': wsck,
+            'items': [new_session(i) for j in range(20)]})),
+        ('getConferenceSessions', anyone(lambda i: {
+            'websafeConferenceKey': rnd.choice(confs)})),
+        ('getAllSessions', anyone(lambda i: {'pageSize': 100})),
+        ('getSessionsBySpeaker', anyone(lambda i: {
+            'speaker': rnd.choice(data['speakers'])})),
+        ('getSpeakers', anyone(lambda i: {'prefix': 'spea'})),
+        ('autocomplete', anyone(lambda i: {
+            'prefix': rnd.choice(['lon', 'conf', 'pyth', 'session 1'])})),
+        ('getConferenceSessionsByType', anyone(lambda i: {
+            'websafeConferenceKey': rnd.choice(confs),
+            'typeOfSession': 'lecture'})),
+        ('addSessionToWishlist', anyone(lambda i: {
+            'websafeSessionKey': rnd.choice(data['sessions'])})),
+        ('getSessionsInWishlist', anyone(lambda i: {
+            'websafeConferenceKey': rnd.choice(confs)})),
+        ('getConferenceAndSessionByDate', anyone(lambda i: {
+            'date': rnd.choice(data['dates'])})),
+        ('getConferenceAndSessionByKeyword', anyone(lambda i: {
+            'keyword': rnd.choice(['python', 'web cloud', 'london'])})),
+        ('querySession', anyone(lambda i: {
+            'typeOfSession': 'workshop', 'startTime': '19:00'})),
+        ('getFeaturedSpeaker', anyone(lambda i: {
+            'websafeConferenceKey': rnd.choice(confs)})),
+    ]
+
+
+def build_request(request_type, values):
+    """Fill a request message, including nested and repeated messages."""
+    from protorpc import messages
+
+    request = request_type()
+    for name, value in values.items():
+        field = request_type.field_by_name(name)
+        if isinstance(field, messages.MessageField):
+            if field.repeated:
+                value = [build_request(field.type, v) for v in value]
+            else:
+                value = build_request(field.type, value)
+        setattr(request, name, value)
+    return request
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--profiles', type=int, default=200)
+    parser.add_argument('--conferences', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='sessions per conference')
+    parser.add_argument('--speakers', type=int, default=300)
+    parser.add_argument('--wishlists', type=int, default=5,
+                        help='wishlist entries per profile')
+    parser.add_argument('--calls', type=int, default=50,
+                        help='calls per case')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', help='run only cases with this name')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON to compare with')
+    args = parser.parse_args()
+
+    tb = common.make_testbed()
+    from google.appengine.api import users
+    from google.appengine.ext import ndb
+    import conference
+
+    # identity: each user's bearer token resolves through a stub tokeninfo
+    conference.VERIFY_ID_TOKENS_LOCALLY = False
+    conference.urlfetch.fetch = lambda url, *a, **kw: StubResponse(json.dumps(
+        {'user_id': url.rsplit('token-', 1)[1], 'expires_in': 3600}))
+    acting = {}
+    conference.endpoints.get_current_user = lambda: users.User(
+        '%s@example.com' % acting['user'])
+
+    data = seed(args)
+    rnd = random.Random(args.seed)
+    recorder = RpcRecorder()
+    recorder.install()
+    api = conference.ConferenceApi()
+
+    results = {}
+    requests = itertools.count()
+    for name, build in make_cases(data, rnd):
+        if args.only and name != args.only:
+            continue
+        method = getattr(api, name)
+        request_type = getattr(conference.ConferenceApi, name).remote.request_type
+        label = name
+        if label in results:
+            label = '%s#%d' % (name, len(
+                [k for k in results if k.split('#')[0] == name]) + 1)
+        samples, rpcs, entities, errors = [], defaultdict(int), 0, 0
+        last_error = None
+        for i in range(args.calls):
+            user, values = build(i)
+            acting['user'] = user
+            os.environ['HTTP_AUTHORIZATION'] = 'Bearer token-%s' % user
+            os.environ['REQUEST_LOG_ID'] = str(next(requests))
+            request = build_request(request_type, values)
+            # every request starts with an empty ndb context cache
+            ndb.get_context().clear_cache()
+            recorder.reset()
+            try:
+                _, ms = common.timed(method, request)
+            except Exception as e:
+                errors += 1
+                last_error = '%s: %s' % (type(e).__name__, e)
+                continue
+            samples.append(ms)
+            for call, count in recorder.calls.items():
+                rpcs[call] += count
+            entities += recorder.entities
+        calls = max(len(samples), 1)
+        results[label] = dict(common.percentiles(samples),
+            errors=errors,
+            last_error=last_error,
+            rpcs=dict((call, float(count) / calls) for call, count in rpcs.items()),
+            datastore_rpcs=float(sum(count for call, count in rpcs.items()
+                                     if call.startswith('datastore_v3.'))) / calls,
+            entities=float(entities) / calls)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    print '%d profiles, %d conferences, %d sessions each, %d calls per case' % (
+        args.profiles, args.conferences, args.sessions, args.calls)
+    print common.HEADER + ' %7s %8s %6s' % ('ds rpcs', 'entities', 'errors')
+    for label in sorted(results):
+        stats = results[label]
+        print common.format_row(label, stats) + ' %7.1f %8.1f %6d' % (
+            stats.get('datastore_rpcs', 0), stats.get('entities', 0),
+            stats['errors'])
+        if stats['last_error']:
+            print '%-36s %s' % ('  last error', stats['last_error'])
+        old = baseline.get(label)
+        if old and old.get('n') and stats.get('n'):
+            print '%-36s p50 %+.1f%%  p95 %+.1f%%  ds rpcs %+.1f  entities %+.1f' % (
+                '  vs baseline',
+                100.0 * (stats['p50'] - old['p50']) / (old['p50'] or 1),
+                100.0 * (stats['p95'] - old['p95']) / (old['p95'] or 1),
+                stats['datastore_rpcs'] - old['datastore_rpcs'],
+                stats['entities'] - old['entities'])
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f,
+                      indent=2, sort_keys=True)
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
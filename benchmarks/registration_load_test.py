@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""registration_load_test.py
+
+Local load test of registration against a single hot conference:
+registrations per second, transaction attempts and failures for the old
+single-entity-group transaction (Profile + Conference) against the
+sharded seat counters in seats.py.
+
+The datastore stub has no per-entity-group write limit, so --latency
+delays every commit (as a real commit round trip would) so that
+overlapping transactions on one group conflict and retry.
+
+    python benchmarks/registration_load_test.py [--users N] [--threads T]
+
+"""
+
+import argparse
+import threading
+import time
+from Queue import Queue, Empty
+
+import common
+common.fix_path()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=10.0,
+                        help='ms each commit is delayed')
+    args = parser.parse_args()
+
+    tb = common.make_testbed()
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import datastore_errors
+    from google.appengine.ext import ndb
+    from models import Conference, ConflictException, Profile
+    import seats
+
+    latency = args.latency / 1000.0
+    attempts = {'count': 0}
+    lock = threading.Lock()
+
+    def datastore_hook(service, call, request, response):
+        """Count transaction attempts; hold each one open before commit."""
+        if call == 'BeginTransaction':
+            with lock:
+                attempts['count'] += 1
+        elif call == 'Commit':
+            time.sleep(latency)
+
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'registration_load_test', datastore_hook, 'datastore_v3')
+
+    @ndb.transactional(xg=True)
+    def legacy_register(p_key, c_key):
+        """What _conferenceRegistration did before sharding."""
+        prof, conf = ndb.get_multi([p_key, c_key])
+        if conf.seatsAvailable <= 0:
+            raise ConflictException("There are no seats available.")
+        prof.conferenceKeysToAttend.append(c_key.urlsafe())
+        conf.seatsAvailable -= 1
+        ndb.put_multi([prof, conf])
+
+    def sharded_register(p_key, c_key):
+        seats.register(p_key, c_key, seats.NUM_SHARDS)
+
+    def seed(label):
+        organizer = Profile(id='organizer-%s' % label, displayName='Organizer')
+        organizer.put()
+        conf = Conference(parent=organizer.key, name='Hot %s' % label,
+            maxAttendees=args.users, seatsAvailable=args.users,
+            organizerUserId=organizer.key.id())
+        conf.put()
+        users = [Profile(id='%s-user-%d' % (label, i), displayName='User %d' % i)
+                 for i in range(args.users)]
+        ndb.put_multi(users)
+        return conf.key, [u.key for u in users]
+
+    def run(label, register):
+        c_key, user_keys = seed(label)
+        if label == 'sharded':
+            seats.ensureShards(c_key)
+        work = Queue()
+        for p_key in user_keys:
+            work.put(p_key)
+        failures = {'count': 0}
+        attempts['count'] = 0
+
+        def worker():
+            while True:
+                try:
+                    p_key = work.get_nowait()
+                except Empty:
+                    return
+                try:
+                    register(p_key, c_key)
+                except (datastore_errors.TransactionFailedError,
+                        ConflictException):
+                    with lock:
+                        failures['count'] += 1
+
+        threads = [threading.Thread(target=worker) for i in range(args.threads)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        done = args.users - failures['count']
+        print '%-10s %8d %8d %10d %12.1f' % (label, done, failures['count'],
+            attempts['count'], done / elapsed)
+
+    print '%d users, %d threads, %.0f ms per commit' % (
+        args.users, args.threads, args.latency)
+    print '%-10s %8s %8s %10s %12s' % (
+        'path', 'ok', 'failed', 'attempts', 'regs/sec')
+    run('legacy', legacy_register)
+    run('sharded', sharded_register)
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""trace_replay.py
+
+Replay a trace of recorded ConferenceApi calls against seeded testbed
+stubs and report throughput and latency percentiles per method.
+
+Traces are the "trace {...}" lines logged by instrumentation.py when
+settings.TRACE_SAMPLE_RATE is above 0; download them with appcfg.py
+request_logs (or copy them from the Logs Viewer) and pass the file as
+is, other lines are skipped. Recorded conference and session keys, and
+user pseudonyms, don't exist in the testbed, so each distinct one is
+mapped onto a seeded entity in order of first appearance, which keeps
+the trace's skew towards hot conferences and busy users. Calls are
+issued at their recorded offsets divided by --speed, one at a time;
+--speed 0 replays back to back.
+
+    python benchmarks/trace_replay.py TRACE [--speed N] [--conferences N]
+        [--limit N] [--only NAME]
+
+"""
+
+import argparse
+import itertools
+import json
+import os
+import re
+import time
+from collections import defaultdict
+
+import common
+common.fix_path()
+import endpoint_benchmark
+
+TRACE_RE = re.compile(r'\btrace (\{.*\})\s*$')
+# methods that only the conference's organizer may call
+ORGANIZER_METHODS = frozenset(['updateConference', 'createSession',
+                               'createSessions'])
+
+
+def read_trace(path, limit=None):
+    """Return the trace records in a log file, oldest first."""
+    records = []
+    with open(path) as f:
+        for line in f:
+            match = TRACE_RE.search(line)
+            if not match:
+                continue
+            try:
+                records.append(json.loads(match.group(1)))
+            except ValueError:
+                continue
+    records.sort(key=lambda r: r['t'])
+    return records[:limit] if limit else records
+
+
+class Remapper(object):
+    """Map recorded ids onto seeded ones in order of first appearance."""
+
+    def __init__(self, seeded):
+        self.seeded = seeded
+        self.mapped = {}
+
+    def __call__(self, recorded):
+        if recorded not in self.mapped:
+            self.mapped[recorded] = self.seeded[
+                len(self.mapped) % len(self.seeded)]
+        return self.mapped[recorded]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('trace', help='log file with trace lines')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed; 0 for back to back')
+    parser.add_argument('--profiles', type=int, default=200)
+    parser.add_argument('--conferences', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='sessions per conference')
+    parser.add_argument('--speakers', type=int, default=300)
+    parser.add_argument('--wishlists', type=int, default=5,
+                        help='wishlist entries per profile')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--limit', type=int, help='replay the first N calls')
+    parser.add_argument('--only', help='replay only calls of this method')
+    args = parser.parse_args()
+
+    records = [r for r in read_trace(args.trace, args.limit)
+               if not args.only or r['method'] == args.only]
+    if not records:
+        parser.error('no trace lines in %s' % args.trace)
+
+    tb = common.make_testbed()
+    from google.appengine.api import users
+    from google.appengine.ext import ndb
+    from protorpc import protojson
+    import conference
+
+    conference.VERIFY_ID_TOKENS_LOCALLY = False
+    conference.urlfetch.fetch = lambda url, *a, **kw: \
+        endpoint_benchmark.StubResponse(json.dumps(
+            {'user_id': url.rsplit('token-', 1)[1], 'expires_in': 3600}))
+    acting = {}
+    conference.endpoints.get_current_user = lambda: users.User(
+        '%s@example.com' % acting['user'])
+
+    data = endpoint_benchmark.seed(args)
+    conference_of = Remapper(data['conferences'])
+    session_of = Remapper(data['sessions'])
+    user_of = Remapper(data['users'])
+    api = conference.ConferenceApi()
+
+    samples = defaultdict(list)
+    recorded = defaultdict(list)
+    errors = defaultdict(int)
+    last_errors = {}
+    skipped = defaultdict(int)
+    lag = []
+    requests = itertools.count()
+    first = records[0]['t']
+    start = time.time()
+    for record in records:
+        name = record['method']
+        method = getattr(api, name, None)
+        if method is None:
+            skipped[name] += 1
+            continue
+        request_type = getattr(conference.ConferenceApi, name).remote.request_type
+
+        values = dict(record.get('request') or {})
+        if values.get('websafeConferenceKey'):
+            values['websafeConferenceKey'] = conference_of(
+                values['websafeConferenceKey'])
+        if values.get('websafeSessionKey'):
+            values['websafeSessionKey'] = session_of(values['websafeSessionKey'])
+        if name in ORGANIZER_METHODS and values.get('websafeConferenceKey'):
+            user = data['organizers'][values['websafeConferenceKey']]
+        else:
+            user = user_of(record.get('user'))
+        request = protojson.decode_message(request_type, json.dumps(values))
+
+        if args.speed:
+            due = start + (record['t'] - first) / args.speed
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                lag.append(-wait * 1000.0)
+
+        acting['user'] = user
+        os.environ['HTTP_AUTHORIZATION'] = 'Bearer token-%s' % user
+        os.environ['REQUEST_LOG_ID'] = str(next(requests))
+        ndb.get_context().clear_cache()
+        try:
+            _, ms = common.timed(method, request)
+        except Exception as e:
+            errors[name] += 1
+            last_errors[name] = '%s: %s' % (type(e).__name__, e)
+            continue
+        samples[name].append(ms)
+        if record.get('ms') is not None and not record.get('error'):
+            recorded[name].append(record['ms'])
+    elapsed = time.time() - start
+
+    replayed = sum(len(s) for s in samples.values()) + sum(errors.values())
+    print '%d calls over %.1f s recorded, replayed in %.1f s at %s' % (
+        len(records), records[-1]['t'] - first, elapsed,
+        '%gx' % args.speed if args.speed else 'full speed')
+    print '%.1f calls/s; %d calls behind schedule, by %.1f ms at most' % (
+        replayed / (elapsed or 1), len(lag), max(lag) if lag else 0)
+    print common.HEADER + ' %9s %6s' % ('rec p50', 'errors')
+    for name in sorted(set(samples) | set(errors)):
+        stats = common.percentiles(samples[name])
+        old = common.percentiles(recorded[name])
+        print common.format_row(name, stats) + ' %9s %6d' % (
+            '%.1f' % old['p50'] if old['n'] else '-', errors[name])
+        if name in last_errors:
+            print '%-36s %s' % ('  last error', last_errors[name])
+    for name in sorted(skipped):
+        print '%-36s skipped %d calls, no such method' % (name, skipped[name])
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Udacity conference server-side Python App Engine in-instance caching
+helpers: a bounded LRU with per-entry expiry, hit/miss counters that
+are folded into memcache so they can be read across instances, and
+generation counters for invalidating families of memcache keys.
+
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from collections import defaultdict
+
+from google.appengine.api import memcache
+
+
+MEMCACHE_COUNTERS_NAMESPACE = 'counters'
+COUNTERS_FLUSH_INTERVAL = 10        # seconds between memcache flushes
+BLOB_CAS_RETRIES = 5
+
+# every Counters instance, by namespace; read by the admin stats handler
+ALL_COUNTERS = {}
+
+
+class LRUCache(object):
+    """Thread-safe, size-bounded LRU cache with per-entry expiry.
+
+    Lives for the lifetime of the instance, so it is only suitable for
+    values that are safe to share between requests.
+    """
+
+    def __init__(self, max_size=1000, default_ttl=None):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return cached value for key, or default if absent/expired."""
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                return default
+            # re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Cache value under key for ttl seconds (None = no expiry)."""
+        if ttl is None:
+            ttl = self.default_ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            # evict least recently used entries
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Drop key from the cache, if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Counters(object):
+    """Named in-instance counters, periodically added to memcache.
+
+    Incrementing is a local operation; pending deltas are pushed with
+    a single offset_multi() at most every COUNTERS_FLUSH_INTERVAL
+    seconds, so counting never adds an RPC to the hot path.
+    """
+
+    def __init__(self, namespace, names=(), listed=True):
+        """listed=False keeps the counters out of stats_snapshot(), for
+        families of names too large to report wholesale; those keep no
+        per-instance totals either, only deltas not yet flushed, so an
+        instance's memory doesn't grow with every name it has seen."""
+        self.namespace = namespace
+        self.listed = listed
+        self._names = set(names)
+        self._local = dict.fromkeys(self._names, 0)
+        self._pending = {}
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+        if listed:
+            ALL_COUNTERS[namespace] = self
+
+    def incr(self, name, delta=1):
+        """Add delta to counter name."""
+        self.incr_multi({name: delta})
+
+    def incr_multi(self, deltas):
+        """Add each of a {name: delta} dict to its counter."""
+        with self._lock:
+            for name, delta in deltas.items():
+                if self.listed:
+                    self._names.add(name)
+                    self._local[name] = self._local.get(name, 0) + delta
+                self._pending[name] = self._pending.get(name, 0) + delta
+            due = time.time() - self._last_flush >= COUNTERS_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Push pending deltas to memcache."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        if pending:
+            memcache.offset_multi(pending,
+                key_prefix='%s.' % self.namespace,
+                namespace=MEMCACHE_COUNTERS_NAMESPACE,
+                initial_value=0)
+
+    def snapshot(self):
+        """Return this instance's counter values."""
+        with self._lock:
+            return dict(self._local)
+
+    def fleet_snapshot(self, names=None):
+        """Return counter values summed over all instances; names
+        defaults to the counters this instance has seen."""
+        self.flush()
+        names = list(self._names if names is None else names)
+        values = memcache.get_multi(names,
+            key_prefix='%s.' % self.namespace,
+            namespace=MEMCACHE_COUNTERS_NAMESPACE)
+        return dict((name, int(values.get(name, 0))) for name in names)
+
+
+class CounterBlobs(object):
+    """Families of counters kept as one {name: value} dict per memcache
+    key, such as all of a time window's, so reading a family back is a
+    single key however many names it holds.
+
+    Like Counters, deltas are pushed at most every
+    COUNTERS_FLUSH_INTERVAL seconds; each blob is merged with
+    compare-and-set, and a flush that loses BLOB_CAS_RETRIES races in a
+    row drops its deltas, so the totals are best effort. With max_names,
+    a blob takes no new names once it holds that many.
+    """
+
+    def __init__(self, namespace, expiry=0, max_names=None):
+        self.namespace = namespace
+        self.expiry = expiry
+        self.max_names = max_names
+        self._pending = defaultdict(lambda: defaultdict(int))
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+
+    def incr_multi(self, blob, deltas):
+        """Add each of a {name: delta} dict to its counter in blob."""
+        with self._lock:
+            for name, delta in deltas.items():
+                self._pending[blob][name] += delta
+            due = time.time() - self._last_flush >= COUNTERS_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Merge pending deltas into their blobs in memcache."""
+        with self._lock:
+            pending = self._pending
+            self._pending = defaultdict(lambda: defaultdict(int))
+            self._last_flush = time.time()
+        client = memcache.Client()
+        for blob, deltas in pending.items():
+            key = '%s.%s' % (self.namespace, blob)
+            for i in range(BLOB_CAS_RETRIES):
+                stored = client.gets(key, namespace=MEMCACHE_COUNTERS_NAMESPACE)
+                values = dict(stored or {})
+                for name, delta in sorted(deltas.items()):
+                    if name in values or self.max_names is None or \
+                            len(values) < self.max_names:
+                        values[name] = values.get(name, 0) + delta
+                if stored is None:
+                    if client.add(key, values, time=self.expiry,
+                                  namespace=MEMCACHE_COUNTERS_NAMESPACE):
+                        break
+                elif client.cas(key, values, time=self.expiry,
+                                namespace=MEMCACHE_COUNTERS_NAMESPACE):
+                    break
+
+    def fleet_snapshot(self, blobs):
+        """Return {blob: {name: value}} summed over all instances."""
+        self.flush()
+        values = memcache.get_multi(list(blobs),
+            key_prefix='%s.' % self.namespace,
+            namespace=MEMCACHE_COUNTERS_NAMESPACE)
+        return dict((blob, values.get(blob) or {}) for blob in blobs)
+
+
+def stats_snapshot():
+    """Return local and fleet-wide values of every registered counter."""
+    return dict((namespace, {
+        'instance': counters.snapshot(),
+        'fleet': counters.fleet_snapshot(),
+    }) for namespace, counters in ALL_COUNTERS.items())
+
+
+class Generation(object):
+    """A memcache counter that versions a family of cache keys.
+
+    Readers embed current() in their keys; writers bump() it, which
+    orphans every key built from the old value at once. A lost counter
+    is reseeded from the clock so old generations aren't reused.
+
+    Queries that aren't strongly consistent can miss a write for a few
+    seconds after its bump, so readers should check settled() before
+    caching what they read under the new generation.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.bumped_key = key + ':bumped'
+
+    def _seed(self):
+        memcache.add(self.key, int(time.time() * 1000))
+
+    def current(self):
+        value = memcache.get(self.key)
+        if value is None:
+            self._seed()
+            value = memcache.get(self.key)
+        return value
+
+    def bump(self):
+        # stamp first, so no reader sees the new value as settled early
+        memcache.set(self.bumped_key, time.time())
+        if memcache.incr(self.key) is None:
+            self._seed()
+
+    def settled(self, seconds):
+        """True if the last bump was at least seconds ago."""
+        bumped = memcache.get(self.bumped_key)
+        return bumped is None or time.time() - bumped >= seconds
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""concurrency.py
+
+Udacity conference server-side Python App Engine helpers for running
+independent datastore RPCs at the same time
+
+Handlers start each RPC as an ndb future (or a tasklet chaining several)
+and wait on them together, so a request costs about as much as its
+slowest chain of RPCs rather than the sum of all of them.
+
+"""
+
+from google.appengine.ext import ndb
+
+
+def gather(*futures):
+    """Wait for futures together; return their results in order."""
+    ndb.Future.wait_all(futures)
+    return [future.get_result() for future in futures]
+
+
+@ndb.tasklet
+def getKeys_async(keys):
+    """Get the entities of keys, or of a future list of keys, skipping
+    any that no longer exist.
+    """
+    if isinstance(keys, ndb.Future):
+        keys = yield keys
+    entities = yield ndb.get_multi_async(keys)
+    raise ndb.Return([e for e in entities if e])
+
+
+@ndb.tasklet
+def fetchPageWithParents_async(query, page_size, start_cursor=None,
+                               projection=None):
+    """Fetch a page of query, getting each result's parent entity as the
+    results come in rather than after the last one has arrived.
+
+    Returns (entities, {parent key: parent}, next cursor, more).
+    """
+    @ndb.tasklet
+    def withParent(batch, index, entity):
+        parent_key = entity.key.parent()
+        parent = (yield parent_key.get_async()) if parent_key else None
+        raise ndb.Return(entity, parent, batch.cursor(index + 1))
+
+    # one result past the page says whether there is another page
+    rows = yield query.map_async(withParent, limit=page_size + 1,
+        start_cursor=start_cursor, projection=projection,
+        produce_cursors=True, pass_batch_into_callback=True)
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    entities = [entity for entity, parent, cursor in rows]
+    parents = dict((parent.key, parent) for entity, parent, cursor in rows
+                   if parent)
+    next_cursor = rows[-1][2] if more else None
+    raise ndb.Return(entities, parents, next_cursor, more)
@@ -13,21 +13,27 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 from datetime import datetime
+from datetime import timedelta
+import hashlib
 import json
+import logging
 import os
+import threading
 import time
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api import urlfetch
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
-from models import ConflictException
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
@@ -36,23 +42,67 @@ from models import BooleanMessage
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
-from models import ConferenceQueryForm
 from models import ConferenceQueryForms
 from models import TeeShirtSize
 from models import Session, SessionForm, SessionForms
 from models import Wishlist, WishlistForm
+from models import SpeakerCount
+from models import SpeakerForm, SpeakerForms
+from models import SuggestionForm, SuggestionForms
 from models import ConferenceFormAndSessionForm
 
+import autocomplete
+from cache import Counters
+from cache import Generation
+from cache import LRUCache
+import concurrency
+import converters
+import feed
+import idtoken
+from instrumentation import instrumented
+from instrumentation import transactional
+import search
+import seats
+import speakers
+
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
+from settings import VERIFY_ID_TOKENS_LOCALLY
 
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-SAME_SPEAKER_SESSION=""
+MEMCACHE_ANNOUNCEMENTS_KEY = "NEARLY_SOLD_OUT_ANNOUNCEMENT"  # (set, announcement)
+MEMCACHE_ANNOUNCEMENTS_LOCK_KEY = "NEARLY_SOLD_OUT_ANNOUNCEMENT_LOCK"
+NEARLY_SOLD_OUT_SEATS = 5
+ANNOUNCEMENT_LOCK_TTL = 30
+ANNOUNCEMENT_LOCAL_TTL = 30     # seconds an instance reuses its copy
+ANNOUNCEMENT_CAS_RETRIES = 5
+MEMCACHE_FEATURED_SPEAKER_PREFIX = "FEATURED_SPEAKER:"
+MEMCACHE_IDENTITY_NAMESPACE = "identity"
+MEMCACHE_CONFERENCE_PREFIX = "CONFERENCE"
+CONFERENCE_CACHE_VERSION = 1    # bump when ConferenceForm changes shape
+CONFERENCE_CACHE_TTL = 600
+CONFERENCE_LEASE_TTL = 60   # seconds an invalidation blocks late fills
+CONFERENCE_INVALIDATED = 'invalidated'
+MEMCACHE_QUERY_PREFIX = "CONFERENCE_QUERY"
+QUERY_CACHE_TTL = 300
+QUERY_CACHE_SETTLE = 5      # seconds after a bump before results are cached
+IDENTITY_CACHE_SIZE = 5000
+IDENTITY_MAX_TTL = 3600     # seconds; tokens usually expire sooner
+
+IDENTITY_CACHE = LRUCache(max_size=IDENTITY_CACHE_SIZE)
+IDENTITY_COUNTERS = Counters('identity',
+    ('request_hit', 'local_hit', 'memcache_hit', 'miss'))
+CONFERENCE_CACHE_COUNTERS = Counters('conference_cache', ('hit', 'miss'))
+QUERY_CACHE_COUNTERS = Counters('query_cache', ('hit', 'miss'))
+# bumped by every conference write; versions the queryConferences cache
+CONFERENCE_GENERATION = Generation("CONFERENCE_GENERATION")
+ANNOUNCEMENT_CACHE = LRUCache(max_size=1, default_ttl=ANNOUNCEMENT_LOCAL_TTL)
+_request_identity = threading.local()
+ID_TOKEN_AUDIENCES = (WEB_CLIENT_ID, ANDROID_AUDIENCE)
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -94,13 +144,46 @@ SESS_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
     )
 
+SESSIONS_POST_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(1),
+    )
+
 SESS_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1))
 
+SESS_PAGE_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+    fields=messages.StringField(4, repeated=True))
+
 SESS_SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    speaker=messages.StringField(1))
+    speaker=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+    fields=messages.StringField(4, repeated=True))
+
+AUTOCOMPLETE_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    prefix=messages.StringField(1, required=True),
+    field=messages.StringField(2),
+    limit=messages.IntegerField(3))
+
+SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    prefix=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3))
+
+PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1),
+    pageToken=messages.StringField(2),
+    fields=messages.StringField(3, repeated=True))
 
 WISH_POST_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage, 
@@ -112,15 +195,29 @@ SESS_DATE_GET_REQUEST = endpoints.ResourceContainer(
 
 SESS_KEYWORD_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    keyword=messages.StringField(1, required = True)
+    keyword=messages.StringField(1, required = True),
+    limit=messages.IntegerField(2)
     )
 
+KEYWORD_SEARCH_DEFAULT_LIMIT = 20
+KEYWORD_SEARCH_MAX_LIMIT = 100
+MAX_SESSIONS_PER_BATCH = 200
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+MAX_ACTIVE_DAYS = 366
+
+# Properties fetched by projection when a field mask needs nothing else.
+# Each tuple is backed by a composite index in index.yaml, so they can
+# only be used for the query shapes those indexes cover.
+CONFERENCE_PROJECTION = ('name', 'city', 'endDate', 'maxAttendees', 'month',
+    'organizerUserId', 'seatsAvailable', 'startDate')
+SESSION_PROJECTION = ('conferenceBelongTo', 'date', 'duration',
+    'organizerUserId', 'sessionName', 'speaker', 'startTime', 'typeOfSession')
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-def _getUserId():
-    """A workaround implementation for getting userid."""
-    auth = os.getenv('HTTP_AUTHORIZATION')
-    bearer, token = auth.split()
+def _fetchTokenInfo(token):
+    """Verify token against the tokeninfo service; return its info dict."""
     token_type = 'id_token'
     if 'OAUTH_USER_ID' in os.environ:
         token_type = 'access_token'
@@ -139,7 +236,239 @@ def _getUserId():
         else:
             time.sleep(wait)
             wait = wait + i
-    return user.get('user_id', '')
+    return user
+
+
+def _verifyToken(token):
+    """Return tokeninfo-style dict for token, verifying locally if we can."""
+    if VERIFY_ID_TOKENS_LOCALLY and idtoken.looks_like_jwt(token):
+        try:
+            claims = idtoken.verify_id_token(token, ID_TOKEN_AUDIENCES)
+        except idtoken.InvalidTokenError as e:
+            logging.info('Rejected ID token: %s', e)
+            return {}
+        except idtoken.CertificateError as e:
+            # can't get signing keys; let tokeninfo decide instead
+            logging.warning('Falling back to tokeninfo: %s', e)
+        else:
+            return {
+                'user_id': claims['sub'],
+                'expires_in': int(claims['exp'] - time.time()),
+            }
+    return _fetchTokenInfo(token)
+
+
+def _getUserId():
+    """A workaround implementation for getting userid.
+
+    Verified identities are cached by a hash of the bearer token: once
+    per request, then in the instance LRU and in memcache until the
+    token's own expiry, so tokeninfo is hit once per token per fleet.
+    """
+    auth = os.getenv('HTTP_AUTHORIZATION')
+    bearer, token = auth.split()
+    token_hash = hashlib.sha256(token).hexdigest()
+
+    # one request never verifies the same token twice
+    request_id = os.getenv('REQUEST_LOG_ID', '')
+    memo = getattr(_request_identity, 'memo', None)
+    if memo and memo[:2] == (request_id, token_hash):
+        IDENTITY_COUNTERS.incr('request_hit')
+        return memo[2]
+
+    user_id = IDENTITY_CACHE.get(token_hash)
+    if user_id is not None:
+        IDENTITY_COUNTERS.incr('local_hit')
+    else:
+        cached = memcache.get(token_hash, namespace=MEMCACHE_IDENTITY_NAMESPACE)
+        if cached:
+            # keep the instance copy no longer than the token is valid
+            user_id, expires = cached
+            IDENTITY_CACHE.set(token_hash, user_id, ttl=expires - time.time())
+            IDENTITY_COUNTERS.incr('memcache_hit')
+        else:
+            IDENTITY_COUNTERS.incr('miss')
+            user = _verifyToken(token)
+            user_id = user.get('user_id', '')
+            ttl = min(int(user.get('expires_in', 0)), IDENTITY_MAX_TTL)
+            # never cache failed verifications
+            if user_id and ttl > 0:
+                IDENTITY_CACHE.set(token_hash, user_id, ttl=ttl)
+                memcache.set(token_hash, (user_id, time.time() + ttl),
+                    time=ttl, namespace=MEMCACHE_IDENTITY_NAMESPACE)
+
+    _request_identity.memo = (request_id, token_hash, user_id)
+    return user_id
+
+
+def _pageSize(request):
+    """Return the page size asked for, clamped to MAX_PAGE_SIZE."""
+    if request.pageSize is not None and request.pageSize <= 0:
+        raise endpoints.BadRequestException("'pageSize' must be positive")
+    return min(request.pageSize or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+
+
+def _activeDays(start, end):
+    """Return every date from start to end inclusive, for the indexed
+    Conference.activeDays; a conference without an end runs one day.
+    """
+    if not start:
+        return []
+    days = min(((end or start) - start).days, MAX_ACTIVE_DAYS - 1)
+    return [start + timedelta(days=d) for d in range(max(days, 0) + 1)]
+
+
+def _conferenceCacheKey(wsck):
+    """Return the memcache key of a conference's rendered ConferenceForm."""
+    return '%s:v%d:%s' % (MEMCACHE_CONFERENCE_PREFIX,
+        CONFERENCE_CACHE_VERSION, wsck)
+
+
+def _invalidateConferences(wscks):
+    """Replace conferences' cached ConferenceForms with a marker; call
+    after commit.
+
+    A fill that read the conference before the write can only add() to
+    an empty key, so the marker keeps it out; a fill that saw the marker
+    read after the write, and replaces it with compare-and-set.
+    """
+    memcache.set_multi(dict((_conferenceCacheKey(wsck), CONFERENCE_INVALIDATED)
+                            for wsck in wscks), time=CONFERENCE_LEASE_TTL)
+
+
+def _invalidateConference(wsck):
+    """Invalidate one conference's cached ConferenceForm."""
+    _invalidateConferences([wsck])
+
+
+def _conferenceFromData(data, c_key):
+    """Build a new Conference from a dict of ConferenceForm fields.
+
+    Fills in defaults, parses the dates and derives month, activeDays
+    and seatsAvailable.
+    """
+    data = dict(data)
+    # add default values for those missing
+    for df in DEFAULTS:
+        if data.get(df) in (None, []):
+            data[df] = DEFAULTS[df]
+
+    # convert dates from strings to Date objects; set month based on start_date
+    if data.get('startDate'):
+        data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
+        data['month'] = data['startDate'].month
+    else:
+        data['month'] = 0
+    if data.get('endDate'):
+        data['endDate'] = datetime.strptime(data['endDate'][:10], "%Y-%m-%d").date()
+    data['activeDays'] = _activeDays(data.get('startDate'), data.get('endDate'))
+
+    # set seatsAvailable to be same as maxAttendees on creation
+    if data["maxAttendees"] > 0:
+        data["seatsAvailable"] = data["maxAttendees"]
+    data['key'] = c_key
+    return Conference(**data)
+
+
+def _sessionFromData(data, conf):
+    """Build an unkeyed Session of conf from a dict of SessionForm
+    fields, parsing its date and start time.
+    """
+    data = dict(data)
+    data.pop('websafeSessionKey', None)
+    # Convert 'date' and 'time' from string to datetime format
+    if data.get('date'):
+        data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
+    if data.get('startTime'):
+        data['startTime'] = datetime.strptime(data['startTime'][:5], "%H:%M").time()
+    # Define field "conferenceBelongTo" to conf name.
+    data['conferenceBelongTo'] = conf.name
+    return Session(**data)
+
+
+def _isNearlySoldOut(seats_available):
+    return seats_available is not None and \
+        0 < seats_available <= NEARLY_SOLD_OUT_SEATS
+
+
+def _formatAnnouncement(nearly_sold_out):
+    """Format the announcement for a {websafeKey: name} dict."""
+    if not nearly_sold_out:
+        return ""
+    return '%s %s' % (
+        'Last chance to attend! The following conferences '
+        'are nearly sold out:',
+        ', '.join(sorted(nearly_sold_out.values())))
+
+
+def _wishlistKey(user_key, session_key):
+    """Return the deterministic key of a user's wishlist entry for a session."""
+    return ndb.Key(Wishlist, session_key.urlsafe(), parent=user_key)
+
+
+def _responseFields(request, message):
+    """Return the requested field mask as a frozenset, or None for all."""
+    if not request.fields:
+        return None
+    fields = frozenset(request.fields)
+    unknown = fields - set(f.name for f in message.all_fields())
+    if unknown:
+        raise endpoints.BadRequestException(
+            "Unknown field(s): %s" % ', '.join(sorted(unknown)))
+    return fields
+
+
+def _projection(fields, properties, computed=()):
+    """Return properties if fields can be served by projecting them.
+
+    computed are message fields filled from elsewhere (keys, names).
+    """
+    if fields is not None and fields - set(computed) <= set(properties):
+        return properties
+    return None
+
+
+def _fetchPage(query, request, projection=None):
+    """Fetch one page of query per request.pageSize/pageToken.
+
+    Returns (entities, nextPageToken); the token is None on the last page.
+    """
+    items, next_cursor, more = query.fetch_page(_pageSize(request),
+        start_cursor=_pageCursor(request), projection=projection)
+    return items, (next_cursor.urlsafe() if more and next_cursor else None)
+
+
+def _pageCursor(request):
+    """Return the datastore cursor of request.pageToken, or None."""
+    if not request.pageToken:
+        return None
+    try:
+        return Cursor(urlsafe=request.pageToken)
+    except (datastore_errors.BadValueError, TypeError):
+        raise endpoints.BadRequestException("Invalid 'pageToken'")
+
+
+def _pageOffset(request):
+    """Return the list offset of request.pageToken, 0 without one."""
+    try:
+        offset = int(request.pageToken or 0)
+    except ValueError:
+        raise endpoints.BadRequestException("Invalid 'pageToken'")
+    if offset < 0:
+        raise endpoints.BadRequestException("Invalid 'pageToken'")
+    return offset
+
+
+def _fetchKeysPage(keys, request):
+    """Get one page of an ordered key list per request.pageSize/pageToken,
+    where the token is the offset of the page.
+
+    Returns (entities, nextPageToken); the token is None on the last page.
+    """
+    offset = _pageOffset(request)
+    end = offset + _pageSize(request)
+    items = [e for e in ndb.get_multi(keys[offset:end]) if e]
+    return items, (str(end) if end < len(keys) else None)
 
 
 @endpoints.api(name='conference', version='v1', audiences=[ANDROID_AUDIENCE],
@@ -152,20 +481,8 @@ class ConferenceApi(remote.Service):
 
     def _copyConferenceToForm(self, conf, displayName=None):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+        return converters.toForm(conf, ConferenceForm,
+            organizerDisplayName=displayName)
 
 
     def _createConferenceObject(self, request):
@@ -184,35 +501,27 @@ class ConferenceApi(remote.Service):
         del data['websafeKey']
         del data['organizerDisplayName']
 
-        # add default values for those missing (both data model & outbound Message)
+        # add default values for those missing to the outbound Message
         for df in DEFAULTS:
             if data[df] in (None, []):
-                data[df] = DEFAULTS[df]
                 setattr(request, df, DEFAULTS[df])
 
-        # convert dates from strings to Date objects; set month based on start_date
-        if data['startDate']:
-            data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
-            data['month'] = data['startDate'].month
-        else:
-            data['month'] = 0
-        if data['endDate']:
-            data['endDate'] = datetime.strptime(data['endDate'][:10], "%Y-%m-%d").date()
-
-        # set seatsAvailable to be same as maxAttendees on creation
-        if data["maxAttendees"] > 0:
-            data["seatsAvailable"] = data["maxAttendees"]
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
         c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
         c_key = ndb.Key(Conference, c_id, parent=p_key)
-        data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
+        # create Conference along with its keyword index entries, send
+        # email to organizer confirming creation of Conference & return
+        # (modified) ConferenceForm
+        conf = _conferenceFromData(data, c_key)
+        ndb.put_multi([conf] + search.postingsFor(conf))
+        CONFERENCE_GENERATION.bump()
+        self._updateNearlySoldOut(c_key.urlsafe(), conf.name, conf.seatsAvailable)
+        autocomplete.enqueue(*autocomplete.changes([(None, conf)]))
+        feed.schedulePatch(c_key)
         taskqueue.add(params={'email': user.email(),
             'conferenceInfo': repr(request)},
             url='/tasks/send_confirmation_email'
@@ -220,7 +529,7 @@ class ConferenceApi(remote.Service):
         return request
 
 
-    @ndb.transactional()
+    @transactional()
     def _updateConferenceObject(self, request):
         user = endpoints.get_current_user()
         if not user:
@@ -244,6 +553,7 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        typeahead = autocomplete.entriesOf(conf)
         for field in request.all_fields():
             data = getattr(request, field.name)
             # only copy fields where we get data
@@ -255,13 +565,24 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
+        conf.activeDays = _activeDays(conf.startDate, conf.endDate)
+        # an explicit seat count replaces the seat shards; they are
+        # reseeded from it on the next registration
+        if request.seatsAvailable is not None:
+            conf.seatShards = 0
         conf.put()
+        if request.seatsAvailable is not None:
+            seats.clearCachedTotal(conf.key)
+        search.indexEntities([conf])
+        autocomplete.enqueue(*autocomplete.diff(typeahead,
+            autocomplete.entriesOf(conf)), transactional=True)
         prof = ndb.Key(Profile, user_id).get()
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @instrumented
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -270,29 +591,63 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
+    @instrumented
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        cf = self._updateConferenceObject(request)
+        _invalidateConference(request.websafeConferenceKey)
+        CONFERENCE_GENERATION.bump()
+        self._updateNearlySoldOut(cf.websafeKey, cf.name, cf.seatsAvailable)
+        feed.schedulePatch(ndb.Key(urlsafe=cf.websafeKey))
+        return cf
 
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
+    @instrumented
     def getConference(self, request):
-        """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        """Return requested conference (by websafeConferenceKey).
+
+        Read through a memcache copy of the rendered ConferenceForm, so
+        a hit costs no datastore RPCs; writes to the conference or its
+        seats invalidate it.
+        """
+        wsck = request.websafeConferenceKey
+        cache_key = _conferenceCacheKey(wsck)
+        client = memcache.Client()
+        cached = client.gets(cache_key)
+        if cached is not None and cached != CONFERENCE_INVALIDATED:
+            CONFERENCE_CACHE_COUNTERS.incr('hit')
+            return protojson.decode_message(ConferenceForm, cached)
+        CONFERENCE_CACHE_COUNTERS.incr('miss')
+
+        # get Conference and its organizer's Profile (the parent) in one
+        # batch; both land in ndb's in-context cache for this request
+        c_key = ndb.Key(urlsafe=wsck)
+        conf, prof = ndb.get_multi([c_key, c_key.parent()])
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+                'No conference found with key: %s' % wsck)
+        # show the live seat count rather than the last reconciled one
+        conf.seatsAvailable = seats.availableSeats(conf)
+        cf = self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        # add, not set: never overwrite a fresher copy, or an invalidation
+        # that came after our read; cas only replaces the marker we saw
+        if cached is None:
+            client.add(cache_key, protojson.encode_message(cf),
+                time=CONFERENCE_CACHE_TTL)
+        else:
+            client.cas(cache_key, protojson.encode_message(cf),
+                time=CONFERENCE_CACHE_TTL)
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return cf
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(PAGE_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
+    @instrumented
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
@@ -301,13 +656,39 @@ class ConferenceApi(remote.Service):
             raise endpoints.UnauthorizedException('Authorization required')
 
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, _getUserId()))
-        prof = ndb.Key(Profile, _getUserId()).get()
+        p_key = ndb.Key(Profile, _getUserId())
+        fields = _responseFields(request, ConferenceForm)
+        confs, next_page = _fetchPage(Conference.query(ancestor=p_key), request)
+        prof = p_key.get()
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=converters.toForms(confs, ConferenceForm,
+                lambda conf: {'organizerDisplayName': getattr(prof, 'displayName')},
+                fields),
+            nextPageToken=next_page
         )
 
+    @endpoints.method(PAGE_REQUEST, ConferenceForms,
+            path='upcomingConferences',
+            http_method='GET', name='getUpcomingConferences')
+    @instrumented
+    def getUpcomingConferences(self, request):
+        """Return conferences starting today or later, soonest first, a
+        page at a time, from the materialized feed.
+        """
+        fields = _responseFields(request, ConferenceForm)
+        items = feed.items()
+        # the feed is one list, so the page token is an offset into it
+        offset = _pageOffset(request)
+        end = offset + _pageSize(request)
+        page = items[offset:end]
+        if fields is not None:
+            page = [dict((k, v) for k, v in item.items() if k in fields)
+                    for item in page]
+        return ConferenceForms(items=[feed.toForm(item) for item in page],
+            nextPageToken=str(end) if end < len(items) else None)
+
+
     def _getQuery(self, request):
         """Return formatted query from the submitted filters."""
         q = Conference.query()
@@ -319,6 +700,9 @@ class ConferenceApi(remote.Service):
         else:
             q = q.order(ndb.GenericProperty(inequality_filter))
             q = q.order(Conference.name)
+        # a != filter runs as an OR of two queries, which ndb can only
+        # page with cursors when the key is the last sort order
+        q = q.order(Conference.key)
 
         for filtr in filters:
             if filtr["field"] in ["month", "maxAttendees"]:
@@ -356,28 +740,81 @@ class ConferenceApi(remote.Service):
         return (inequality_field, formatted_filters)
 
 
+    def _queryCacheKey(self, request):
+        """Return the queryConferences cache key for request's filters
+        and page, under the current conference generation.
+        """
+        inequality_field, filters = self._formatFilters(request.filters)
+        normalized = sorted(
+            (f["field"], f["operator"],
+             int(f["value"]) if f["field"] in ("month", "maxAttendees") else f["value"])
+            for f in filters)
+        digest = hashlib.sha1(json.dumps(
+            [normalized, _pageSize(request), request.pageToken])).hexdigest()
+        return '%s:%s:%s' % (MEMCACHE_QUERY_PREFIX,
+            CONFERENCE_GENERATION.current(), digest)
+
+
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
             path='queryConferences',
             http_method='POST',
             name='queryConferences')
+    @instrumented
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
+        """Query for conferences.
 
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        The keys of each filter set's page are cached under the current
+        conference generation, so repeated queries skip the datastore
+        query and load conferences and organizers in one get_multi.
+        """
+        fields = _responseFields(request, ConferenceForm)
+        cache_key = self._queryCacheKey(request)
+        cached = memcache.get(cache_key)
+        if cached is not None:
+            QUERY_CACHE_COUNTERS.incr('hit')
+            wscks, next_page = cached
+            c_keys = [ndb.Key(urlsafe=wsck) for wsck in wscks]
+            # organizer Profiles are the conferences' parents
+            p_keys = list(set(c_key.parent() for c_key in c_keys))
+            entities = ndb.get_multi(c_keys + p_keys)
+            conferences = filter(None, entities[:len(c_keys)])
+            profiles = entities[len(c_keys):]
+        else:
+            QUERY_CACHE_COUNTERS.incr('miss')
+            # the unfiltered listing (ordered by name) has an index covering
+            # CONFERENCE_PROJECTION, so a narrow field mask can skip the rest
+            projection = None
+            if not request.filters:
+                projection = _projection(fields, CONFERENCE_PROJECTION,
+                    ('websafeKey', 'organizerDisplayName'))
+
+            # organizers are the conferences' parents, so their profiles
+            # are fetched while the rest of the page is still arriving
+            conferences, organisers, next_cursor, more = \
+                concurrency.fetchPageWithParents_async(self._getQuery(request),
+                    _pageSize(request), _pageCursor(request), projection
+                ).get_result()
+            next_page = next_cursor.urlsafe() if more and next_cursor else None
+            profiles = organisers.values()
+            # right after a write the query may not see it yet; don't
+            # pin that result for the whole TTL
+            if CONFERENCE_GENERATION.settled(QUERY_CACHE_SETTLE):
+                memcache.set(cache_key,
+                    ([conf.key.urlsafe() for conf in conferences], next_page),
+                    time=QUERY_CACHE_TTL)
 
         # put display names in a dict for easier fetching
         names = {}
         for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+            if profile:
+                names[profile.key.id()] = profile.displayName
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+                items=converters.toForms(conferences, ConferenceForm,
+                    lambda conf: {'organizerDisplayName': names.get(conf.organizerUserId)},
+                    fields),
+                nextPageToken=next_page
         )
 
 
@@ -385,17 +822,7 @@ class ConferenceApi(remote.Service):
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        return converters.toForm(prof, ProfileForm)
 
 
     def _getProfileFromUser(self):
@@ -446,6 +873,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
+    @instrumented
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
@@ -453,6 +881,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
+    @instrumented
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -464,40 +893,106 @@ class ConferenceApi(remote.Service):
     def _cacheAnnouncement():
         """Create Announcement & assign to memcache; used by
         memcache cron job & putAnnouncement().
+
+        Rebuilds the nearly-sold-out set from the datastore; since the
+        set is kept up to date incrementally, this is a consistency
+        check that logs when the two had drifted apart.
         """
         confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
+            Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS,
             Conference.seatsAvailable > 0)
         ).fetch(projection=[Conference.name])
+        nearly_sold_out = dict((conf.key.urlsafe(), conf.name) for conf in confs)
 
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = '%s %s' % (
-                'Last chance to attend! The following conferences '
-                'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        stored = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if stored is not None and stored[0] != nearly_sold_out:
+            logging.warning('Nearly sold out set had drifted: cached %r, '
+                'datastore %r', sorted(stored[0]), sorted(nearly_sold_out))
 
+        # store "" rather than deleting, so a missing key means evicted
+        announcement = _formatAnnouncement(nearly_sold_out)
+        memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, (nearly_sold_out, announcement))
         return announcement
 
 
+    @staticmethod
+    def _recomputeAnnouncement():
+        """Rebuild the announcement unless another request already is.
+
+        Returns the announcement, or None if the rebuild was left to
+        whoever holds the lock.
+        """
+        if not memcache.add(MEMCACHE_ANNOUNCEMENTS_LOCK_KEY, 1,
+                            time=ANNOUNCEMENT_LOCK_TTL):
+            return None
+        try:
+            return ConferenceApi._cacheAnnouncement()
+        finally:
+            memcache.delete(MEMCACHE_ANNOUNCEMENTS_LOCK_KEY)
+
+
+    @staticmethod
+    def _updateNearlySoldOut(wsck, name, seats_available, old_seats=None):
+        """Add or remove a conference from the nearly sold out set
+        when its seatsAvailable crosses the threshold; with no
+        old_seats, always apply its current state.
+        """
+        now_in = _isNearlySoldOut(seats_available)
+        if old_seats is not None and _isNearlySoldOut(old_seats) == now_in:
+            return
+        ConferenceApi._setNearlySoldOut({wsck: name if now_in else None})
+
+
+    @staticmethod
+    def _setNearlySoldOut(changes):
+        """Apply {wsck: name, or None to remove} to the nearly sold out
+        set with one compare-and-set.
+        """
+        client = memcache.Client()
+        for i in range(ANNOUNCEMENT_CAS_RETRIES):
+            stored = client.gets(MEMCACHE_ANNOUNCEMENTS_KEY)
+            if stored is None:
+                # lost from memcache: a full rebuild includes this change
+                break
+            nearly_sold_out = dict(stored[0])
+            for wsck, name in changes.items():
+                if name is not None:
+                    nearly_sold_out[wsck] = name
+                else:
+                    nearly_sold_out.pop(wsck, None)
+            if nearly_sold_out == stored[0]:
+                return
+            if client.cas(MEMCACHE_ANNOUNCEMENTS_KEY,
+                    (nearly_sold_out, _formatAnnouncement(nearly_sold_out))):
+                return
+        ConferenceApi._recomputeAnnouncement()
+
+
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
+    @instrumented
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        """Return Announcement, from the instance copy or memcache."""
+        announcement = ANNOUNCEMENT_CACHE.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if announcement is None:
+            stored = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+            if stored is not None:
+                announcement = stored[1]
+            else:
+                # only one request rebuilds; the rest show nothing meanwhile
+                announcement = self._recomputeAnnouncement()
+            if announcement is None:
+                # don't keep the placeholder past the rebuild
+                return StringMessage(data="")
+            ANNOUNCEMENT_CACHE.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+        return StringMessage(data=announcement)
 
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='conference/announcement/put',
             http_method='GET', name='putAnnouncement')
+    @instrumented
     def putAnnouncement(self, request):
         """Put Announcement into memcache"""
         return StringMessage(data=self._cacheAnnouncement())
@@ -505,67 +1000,61 @@ class ConferenceApi(remote.Service):
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
-        retval = None
+        """Register or unregister user for selected conference.
+
+        Seats are held in sharded counters (see seats.py): each attempt
+        is an XG transaction over the user's Profile and one seat shard,
+        so registrations don't serialize on the Conference entity group.
+        """
         prof = self._getProfileFromUser() # get user Profile
 
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        c_key = ndb.Key(urlsafe=wsck)
+        conf = c_key.get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        num_shards = conf.seatShards or seats.ensureShards(c_key)
 
-        # register
+        # register: raises ConflictException if already registered or
+        # there are no seats left
         if reg:
-            # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
-                raise ConflictException(
-                    "You have already registered for this conference")
-
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
-
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
-
-        # unregister
-        else:
-            # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            retval = seats.register(prof.key, c_key, num_shards)
 
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
+        # unregister: False if user wasn't registered
+        else:
+            retval = seats.unregister(prof.key, c_key, num_shards)
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        if retval:
+            _invalidateConference(wsck)
         return BooleanMessage(data=retval)
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(PAGE_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @instrumented
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
 
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        # the keys live on the profile, so the page token is a list offset
+        offset = _pageOffset(request)
+        end = offset + _pageSize(request)
+        page = prof.conferenceKeysToAttend[offset:end]
+        next_page = str(end) if end < len(prof.conferenceKeysToAttend) else None
+
+        fields = _responseFields(request, ConferenceForm)
+        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in page]
+        # organizers are the conferences' parents, so both are known up
+        # front and can be fetched together
+        organisers = list(set(c_key.parent() for c_key in conf_keys))
+        conferences, profiles = concurrency.gather(
+            concurrency.getKeys_async(conf_keys),
+            concurrency.getKeys_async(organisers))
 
         # put display names in a dict for easier fetching
         names = {}
@@ -573,14 +1062,17 @@ class ConferenceApi(remote.Service):
             names[profile.key.id()] = profile.displayName
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
+        return ConferenceForms(items=converters.toForms(conferences, ConferenceForm,
+            lambda conf: {'organizerDisplayName': names.get(conf.organizerUserId)},
+            fields),
+         nextPageToken=next_page
         )
 
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @instrumented
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
@@ -589,6 +1081,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
+    @instrumented
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
@@ -598,101 +1091,147 @@ class ConferenceApi(remote.Service):
 
     def _copySessionToForm(self, session):
         """copy model Session to SessionForm"""
-        s = SessionForm()
-        for field in s.all_fields():
-            if hasattr(session, field.name):
-                # convert DATE and Time property  to string
-                if field.name in ['date', 'startTime']:
-                    setattr(s, field.name, str(getattr(session, field.name)))
-                else:
-                    setattr(s, field.name, getattr(session, field.name))
-            elif field.name == "websafeSessionKey":
-                setattr(s, field.name, session.key.urlsafe())
-        s.check_initialized()
-        return s
+        return converters.toForm(session, SessionForm)
 
     @staticmethod
-    def _memcacheFeaturedSpeaker(same_speaker_s, data):
-        """Entry Featured Speaker data to mencache key.
-        Args:
-            same_speaker_s : A query of sessions have same speaker.
-            data: A dict. It should contain the creating session's
-                data. 
-        """
-        # Add current session data.
-        s_name = data["sessionName"]
-        s_list = [data["sessionName"]]
-        # Add other sessions data to string and list.
-        for s in same_speaker_s:
-            s_list.append(s.sessionName)
-            s_name = s_name+","+s.sessionName
-
-        # Genarate the feature string and set the memcache key.
-        speaker_session = "Speaker %s has %d sessions in this conference: %s." \
-                    %(data["speaker"], len(s_list), s_name)
-
-        return speaker_session
-
-    @ndb.transactional()
-    def _createSessionObject(self, request, conf):
-        """Create a new session. Called by endpoints.method createSession.
-        Args:
-            conf: It should be a Conference Entity.
+    def _featuredSpeakerMessage(counter):
+        """Format the featured speaker announcement for a SpeakerCount."""
+        return "Speaker %s has %d sessions in this conference: %s." \
+                    %(counter.speaker, counter.count, ",".join(counter.sessionNames))
+
+    @staticmethod
+    def _cacheFeaturedSpeaker(c_key):
+        """Derive a conference's featured speaker -- the one with the
+        most sessions, if more than one -- and set it in memcache.
         """
-        # Check if the current user have logined
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = _getUserId()
+        top = SpeakerCount.query(ancestor=c_key).order(-SpeakerCount.count).get()
+        featured = ""
+        if top and top.count > 1:
+            featured = ConferenceApi._featuredSpeakerMessage(top)
+        memcache.set(MEMCACHE_FEATURED_SPEAKER_PREFIX + c_key.urlsafe(), featured)
+        return featured
 
-        # Check if the current user is the conference owner
-        if user_id != conf.organizerUserId:
-            raise endpoints.UnauthorizedException('You are not the conference organizer.')
+    @staticmethod
+    def _countSpeakerSessions(c_key, sessions):
+        """Add sessions to their speakers' SpeakerCounts in the conference.
+        Must run in the transaction that creates the sessions.
 
+        Returns the updated SpeakerCounts.
+        """
+        by_speaker = {}
+        for s in sessions:
+            if s.speaker:
+                by_speaker.setdefault(speakers.speakerId(s.speaker), []).append(s)
+        counter_keys = [ndb.Key(SpeakerCount, speaker_id, parent=c_key)
+                        for speaker_id in by_speaker]
+        counters = []
+        for counter_key, counter in zip(counter_keys, ndb.get_multi(counter_keys)):
+            new = by_speaker[counter_key.id()]
+            counter = counter or SpeakerCount(key=counter_key,
+                speaker=new[0].speaker, count=0)
+            counter.count += len(new)
+            counter.sessionNames.extend(s.sessionName for s in new)
+            counters.append(counter)
+        return counters
+
+    def _sessionFromForm(self, form, conf):
+        """Validate a SessionForm and build its (unkeyed) Session."""
         # Check if nameSession is not none.
-        if not request.sessionName:
+        if not form.sessionName:
             raise endpoints.BadRequestException("Session 'name' field required")
 
-        # Copy all field in request to data dict. Delete two websafeKey 
-        # which won't store in Session.
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-        del data['websafeConferenceKey']
-        del data['websafeSessionKey']
+        # Copy all SessionForm fields to data dict.
+        data = {field.name: getattr(form, field.name)
+                for field in SessionForm.all_fields()}
+        try:
+            return _sessionFromData(data, conf)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Invalid 'date' or 'startTime' in session '%s'" % form.sessionName)
 
-        # Get the other same conference's session, check if there is a same speaker.
-        conf_s = self._getSessionsOfConferenceByWebsafekey(request)
-        same_speaker_s = conf_s.filter(Session.speaker==data['speaker']).fetch()
-        # If yes, set the memcache key.
-        if same_speaker_s:
-            speaker_session = self._memcacheFeaturedSpeaker(same_speaker_s, data)
-            taskqueue.add(params={"featured_speaker":speaker_session},
-                url='/tasks/memcache_featured_speaker'
+    @transactional()
+    def _storeSessions(self, conf, sessions):
+        """Key and store sessions of conf with their speaker counts, in one
+        transaction; their keyword index entries follow in a task.
+
+        That is at most two entities per session, so a full batch of
+        MAX_SESSIONS_PER_BATCH stays within a commit's 500 entity writes.
+        """
+        # Set the created sessions as children of this conference.
+        c_key = conf.key
+        first, last = Session.allocate_ids(size=len(sessions), parent=c_key)
+        for s, s_id in zip(sessions, range(first, last + 1)):
+            s.key = ndb.Key(Session, s_id, parent=c_key)
+
+        # Count the sessions against their speakers; if any speaker now
+        # has more than one, refresh the featured speaker once we commit.
+        counters = self._countSpeakerSessions(c_key, sessions)
+        ndb.put_multi(sessions + counters)
+
+        # a session has up to a few dozen postings, too many to commit here
+        taskqueue.add(params={'websafeSessionKey': [s.key.urlsafe() for s in sessions]},
+            url='/tasks/index_search',
+            transactional=True
+            )
+
+        if any(counter.count > 1 for counter in counters):
+            taskqueue.add(params={'websafeConferenceKey': c_key.urlsafe()},
+                url='/tasks/memcache_featured_speaker',
+                transactional=True
+                )
+        # The speaker directory is outside this entity group.
+        spoken = [s.key.urlsafe() for s in sessions if s.speaker]
+        if spoken:
+            taskqueue.add(params={'websafeSessionKey': spoken},
+                url='/tasks/index_speakers',
+                transactional=True
                 )
+        autocomplete.enqueue(*autocomplete.changes((None, s) for s in sessions),
+            transactional=True)
 
-        # Convert 'date' and 'time' from string to datetime format
-        if data['date']:
-            data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
-        if data['startTime']:
-            data['startTime'] = datetime.strptime(data['startTime'][:5], "%H:%M").time()
+    def _createSessionObjects(self, websafeConferenceKey, forms):
+        """Create sessions in a conference from SessionForms, all or none.
+        Called by endpoints.methods createSession and createSessions.
+        """
+        # Check if the current user have logined
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = _getUserId()
 
-        # Define field "conferenceBelongTo" to conf name. 
-        data['conferenceBelongTo'] = conf.name
-        # Set this created session as a child of this conference.
-        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-        data['parent'] = c_key
+        conf = ndb.Key(urlsafe=websafeConferenceKey).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % websafeConferenceKey)
 
-        s = Session(**data)
-        s.put()
-        del data['parent']
+        # Check if the current user is the conference owner
+        if user_id != conf.organizerUserId:
+            raise endpoints.UnauthorizedException('You are not the conference organizer.')
 
-        return self._copySessionToForm(s)
+        # Validate the whole batch before writing any of it.
+        sessions = [self._sessionFromForm(form, conf) for form in forms]
+        if sessions:
+            self._storeSessions(conf, sessions)
+        return [self._copySessionToForm(s) for s in sessions]
 
     @endpoints.method(SESS_POST_REQUEST, SessionForm, path='conference/{websafeConferenceKey}/CreateSession',
             http_method='POST', name='createSession')
+    @instrumented
     def createSession(self, request):
         """Create a new session in a conference."""
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        return self._createSessionObject(request, conf)
+        return self._createSessionObjects(request.websafeConferenceKey, [request])[0]
+
+    @endpoints.method(SESSIONS_POST_REQUEST, SessionForms,
+            path='conference/{websafeConferenceKey}/CreateSessions',
+            http_method='POST', name='createSessions')
+    @instrumented
+    def createSessions(self, request):
+        """Create a batch of sessions in a conference, all or none."""
+        if len(request.items) > MAX_SESSIONS_PER_BATCH:
+            raise endpoints.BadRequestException(
+                'At most %d sessions can be created at once.' % MAX_SESSIONS_PER_BATCH)
+        return SessionForms(items=self._createSessionObjects(
+            request.websafeConferenceKey, request.items))
 
     def _getSessionsOfConferenceByWebsafekey(self, request):
         """Get conference by websafekey, return all session in this conference."""
@@ -700,32 +1239,83 @@ class ConferenceApi(remote.Service):
         conf_s = Session.query(ancestor=c_key)
         return conf_s
 
-    @endpoints.method(SESS_GET_REQUEST, SessionForms,
+    @endpoints.method(SESS_PAGE_GET_REQUEST, SessionForms,
             path='getConferenceSessions/{websafeConferenceKey}',
             http_method='GET', name='getConferenceSessions')
+    @instrumented
     def getConferenceSessions(self, request): 
-        """Get all sessions of a conference."""
+        """Get all sessions of a conference, a page at a time."""
+        fields = _responseFields(request, SessionForm)
         conf_s = self._getSessionsOfConferenceByWebsafekey(request)
+        conf_s, next_page = _fetchPage(conf_s, request)
         return SessionForms(
-            items=[self._copySessionToForm(s) for s in conf_s]
+            items=converters.toForms(conf_s, SessionForm, fields=fields),
+            nextPageToken=next_page
         )
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(PAGE_REQUEST, SessionForms,
             path='getAllSessions',
             http_method='GET', name='getAllSessions')
+    @instrumented
     def getAllSessions(self, request):
-        """Get all sessions."""
-        all_s = Session.query().fetch()
-        return SessionForms(items=[self._copySessionToForm(s) for s in all_s])
+        """Get all sessions, a page at a time."""
+        fields = _responseFields(request, SessionForm)
+        # unfiltered and unordered, so covered by the SESSION_PROJECTION index
+        projection = _projection(fields, SESSION_PROJECTION, ('websafeSessionKey',))
+        all_s, next_page = _fetchPage(Session.query(), request, projection)
+        return SessionForms(items=converters.toForms(all_s, SessionForm, fields=fields),
+            nextPageToken=next_page)
 
     @endpoints.method(SESS_SPEAKER_GET_REQUEST, SessionForms, 
             path='getSessionsBySpeaker/{speaker}',
             http_method='GET', name='getSessionsBySpeaker')
+    @instrumented
     def getSessionsBySpeaker(self, request):
-        """Get sessions by speaker."""
-        speaker_s = Session.query().filter(Session.speaker==request.speaker).fetch()
+        """Get sessions by speaker, a page at a time. Names match
+        ignoring case and titles, and by word prefix: "smith" finds both
+        "Dr. Smith" and "John Smith".
+        """
+        fields = _responseFields(request, SessionForm)
+        speaker_s, next_page = _fetchKeysPage(
+            speakers.sessionKeys(request.speaker), request)
         return SessionForms(
-            items=[self._copySessionToForm(s) for s in speaker_s])
+            items=converters.toForms(speaker_s, SessionForm, fields=fields),
+            nextPageToken=next_page)
+
+    @endpoints.method(SPEAKER_GET_REQUEST, SpeakerForms,
+            path='getSpeakers',
+            http_method='GET', name='getSpeakers')
+    @instrumented
+    def getSpeakers(self, request):
+        """List speakers by name, a page at a time; a prefix narrows the
+        list to names with words starting with its words, for autocomplete.
+        """
+        speaker_list, next_cursor, more = speakers.lookup(request.prefix,
+            _pageSize(request), _pageCursor(request))
+        return SpeakerForms(
+            items=converters.toForms(speaker_list, SpeakerForm),
+            nextPageToken=next_cursor.urlsafe() if more and next_cursor else None)
+
+    @endpoints.method(AUTOCOMPLETE_GET_REQUEST, SuggestionForms,
+            path='autocomplete',
+            http_method='GET', name='autocomplete')
+    @instrumented
+    def autocomplete(self, request):
+        """Suggest conference names, topics and cities, and session names,
+        with words starting with the words of a prefix; most common first.
+        """
+        fields = set(f for kind in autocomplete.FIELDS.values() for f in kind)
+        if request.field is not None and request.field not in fields:
+            raise endpoints.BadRequestException(
+                "'field' must be one of %s" % ', '.join(sorted(fields)))
+        if request.limit is not None and request.limit <= 0:
+            raise endpoints.BadRequestException("'limit' must be positive")
+        limit = min(request.limit or autocomplete.DEFAULT_SUGGESTIONS,
+                    autocomplete.MAX_SUGGESTIONS)
+        return SuggestionForms(items=[
+            SuggestionForm(field=field, value=value, count=count)
+            for field, value, count in autocomplete.suggest(
+                request.prefix, limit, request.field)])
 
     @endpoints.method(endpoints.ResourceContainer(
     message_types.VoidMessage,
@@ -733,16 +1323,17 @@ class ConferenceApi(remote.Service):
     typeOfSession=messages.StringField(2)), SessionForms,
             path='getConferenceSessionsByType/{websafeConferenceKey}',
             http_method='POST', name='getConferenceSessionsByType')
+    @instrumented
     def getConferenceSessionsByType(self, request):
         """Get sessions of a conference by session type. If typeOfSession is empty,
         it will return all session of the conference.
         """
         conf_s = self._getSessionsOfConferenceByWebsafekey(request)
         type_conf_s = conf_s.filter(Session.typeOfSession==request.typeOfSession).fetch()
-        return SessionForms(items=[self._copySessionToForm(s) for s in type_conf_s])
+        return SessionForms(items=converters.toForms(type_conf_s, SessionForm))
 
 #==================wish list=================
-    @ndb.transactional(xg=True)
+    @transactional(xg=True)
     def _creatWishlist(self, request):
         "Create a Wishlist, add the session to it."
         # Get the current user, and the its name and key.
@@ -751,28 +1342,40 @@ class ConferenceApi(remote.Service):
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = _getUserId()
         user_key = ndb.Key(Profile, user_id)
-        user_name = user_key.get().displayName
 
-        # Get the session key and session name.
-        session_key =ndb.Key(urlsafe=request.websafeSessionKey)
-        session_name = session_key.get().sessionName
+        # Get the user profile and the session in one batch.
+        session_key = ndb.Key(urlsafe=request.websafeSessionKey)
+        if session_key.kind() != Session._get_kind():
+            raise endpoints.BadRequestException(
+                'Not a session key: %s' % request.websafeSessionKey)
+        profile, session = ndb.get_multi([user_key, session_key])
+        if not session:
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % request.websafeSessionKey)
+        if not profile:
+            raise endpoints.NotFoundException(
+                'No profile found; call getProfile first.')
 
-        # Store the user and session data in a wishlist entity.
+        # Store the user and session data in a wishlist entity. Its key is
+        # derived from user and session, so adding twice is a no-op.
         wishlist = Wishlist(
-            userName=user_name,
+            key=_wishlistKey(user_key, session_key),
+            userName=profile.displayName,
             userKey=user_key,
             sessionKey=session_key,
-            sessionName=session_name)
+            sessionName=session.sessionName,
+            conferenceKey=session_key.parent())
         wishlist.put()
         
         # Return user and session name as a tuple.
-        return user_name, session_name
+        return profile.displayName, session.sessionName
 
 
 
     @endpoints.method(WISH_POST_REQUEST, WishlistForm, 
         path='session/{websafeSessionKey}',
         http_method='POST', name='addSessionToWishlist')
+    @instrumented
     def addSessionToWishlist(self, request):
         """Add session to wishlist.
         Args: 
@@ -784,6 +1387,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESS_GET_REQUEST, SessionForms,
         path='getSessionsInWishlist/{websafeConferenceKey}',
         http_method='GET', name='getSessionsInWishlist')
+    @instrumented
     def getSessionsInWishlist(self, request):
         """Get user's wishlist's sessions in the conference. """
         
@@ -797,21 +1401,15 @@ class ConferenceApi(remote.Service):
         user_id = _getUserId()
         user_key = ndb.Key(Profile, user_id)
 
-        # Get wishlist of the user.
-        user_wish = Wishlist.query(Wishlist.userKey==user_key).fetch()
-
-        # Put all wishlist sessionkey into wish_s_list.
-        wish_s_keys = [w.sessionKey for w in user_wish]
+        # Keys-only ancestor query for the user's entries in this
+        # conference; each entry's id is its session's urlsafe key.
+        w_keys = Wishlist.query(Wishlist.conferenceKey==c_key,
+            ancestor=user_key).fetch(keys_only=True)
+        s_keys = [ndb.Key(urlsafe=w_key.id()) for w_key in w_keys]
 
-        # Add the sessionkeys which belong to the conference to s_list. 
-        s_list = []
-        for s_key in wish_s_keys:
-            if s_key.parent() == c_key:
-                s_list.append(s_key)
-
-        # Get sesssion entity by session key in s_list, and copy to sessionForm. 
-        return SessionForms(
-            items=[self._copySessionToForm(s.get()) for s in s_list])
+        # Load all sessions in one batch, skipping any since deleted.
+        sessions = filter(None, ndb.get_multi(s_keys))
+        return SessionForms(items=converters.toForms(sessions, SessionForm))
 
 #=============task 3====================
 
@@ -820,78 +1418,53 @@ class ConferenceApi(remote.Service):
             http_method='GET',
             path='getConferenceAndSessionByDate', 
             name='getConferenceAndSessionByDate')
+    @instrumented
     def getConferenceAndSessionByDate(self, request):
+        """Get conferences running on, and sessions held on, a date."""
         date = request.date
         date = datetime.strptime(date[:10], "%Y-%m-%d").date()
-        sameday_c = Conference.query().filter(Conference.startDate <= date and\
-            Conference.endDate >= date).fetch()
-        sameday_s = Session.query().filter(Session.date==date).fetch()
+        # activeDays holds each day a conference runs, so "running on
+        # date" is a single equality filter on an indexed property.
+        sameday_c, sameday_s = concurrency.gather(
+            Conference.query(Conference.activeDays==date).fetch_async(),
+            Session.query().filter(Session.date==date).fetch_async())
         return ConferenceFormAndSessionForm( 
             c_data=ConferenceForms(
-                items=[self._copyConferenceToForm(c) for c in sameday_c]
+                items=converters.toForms(sameday_c, ConferenceForm)
                 ),
             s_data=SessionForms(
-                items=[self._copySessionToForm(s) for s in sameday_s]
+                items=converters.toForms(sameday_s, SessionForm)
                 )
             )
 
-    def _keywordFinder(self, data_query, keyword, *fields):
-        """Find keyword in ench entity's selected filter. If found,
-        the add the entity to list and return it.
-        Args:
-            data_query: It should be a ndb query.
-            keyword: String the user input.
-            *fields: Attrabute name of the entity.
-        """
-        output_list = []
-        
-        # Get entities from query.
-        for item in data_query:
-            for f in fields:
-                # For the topics field of Conference is list, we handle it separately.
-                if f == "topics":
-                    for t in getattr(item, f):
-                        if t.find(keyword) != -1:
-                            output_list.append(item)
-                            break
-                # Check if the entity has the attrabute.
-                if hasattr(item, f):
-                    # Check if the attrabute is basestring.
-                    if isinstance(getattr(item, f), (str, unicode)):
-                        # Check if the keyword in the value, if yes,
-                        # put item to output_list and break the for loop.
-                        if getattr(item, f).find(keyword) != -1:
-                            output_list.append(item)
-                            break
-        return output_list
-
-
-
     @endpoints.method(SESS_KEYWORD_GET_REQUEST, ConferenceFormAndSessionForm,
             http_method='GET',
             path='getConferenceAndSessionByKeyword', 
             name='getConferenceAndSessionByKeyword')
+    @instrumented
     def getConferenceAndSessionByKeyword(self, request):
-        """Get conference and session by keyword."""
-        keyword = request.keyword
-
-        # Pass all query, keyword, seleted field to function _keywordFinder()
-        # get the result list back. 
-        all_c = Conference.query().fetch()
-        field_c = ['name', 'description', 'topics']
-        c_list = self._keywordFinder(all_c, keyword, *field_c)
-
-
-        all_s = Session.query().fetch()
-        field_s = ['sessionName', 'highlights', 'conferenceBelongTo']
-        s_list= self._keywordFinder(all_s, keyword, *field_s)
+        """Get conference and session by keyword. Every word of the keyword
+        must match; results are ranked by where the words matched.
+        """
+        if request.limit is not None and request.limit <= 0:
+            raise endpoints.BadRequestException("'limit' must be positive")
+        limit = min(request.limit or KEYWORD_SEARCH_DEFAULT_LIMIT,
+                    KEYWORD_SEARCH_MAX_LIMIT)
+
+        # Resolve matching keys from the keyword index, then load them;
+        # the conference and session lookups run side by side.
+        c_list, s_list = concurrency.gather(
+            concurrency.getKeys_async(
+                search.search_async('Conference', request.keyword, limit)),
+            concurrency.getKeys_async(
+                search.search_async('Session', request.keyword, limit)))
 
         return ConferenceFormAndSessionForm(
             c_data=ConferenceForms(
-                items=[self._copyConferenceToForm(c) for c in c_list]
+                items=converters.toForms(c_list, ConferenceForm)
                 ),
             s_data=SessionForms(
-                items=[self._copySessionToForm(s) for s in s_list]
+                items=converters.toForms(s_list, SessionForm)
                 )
             )
 
@@ -926,19 +1499,29 @@ class ConferenceApi(remote.Service):
             path='querySession',
             http_method='POST',
             name='querySession')
+    @instrumented
     def querySession(self, request):
         """Query for sessions"""
         filter_s = self._getSessionQuery(request)
         return SessionForms(
-            items=[self._copySessionToForm(s) for s in filter_s]
+            items=converters.toForms(filter_s.fetch(), SessionForm)
             )  
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @endpoints.method(CONF_GET_REQUEST, StringMessage,
             path='getFeaturedSpeaker',
             http_method='GET', name='getFeaturedSpeaker')
+    @instrumented
     def getFeaturedSpeaker(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(SAME_SPEAKER_SESSION) or "")
+        """Return the featured speaker of a conference, from memcache."""
+        if not request.websafeConferenceKey:
+            raise endpoints.BadRequestException(
+                "'websafeConferenceKey' is required")
+        featured = memcache.get(
+            MEMCACHE_FEATURED_SPEAKER_PREFIX + request.websafeConferenceKey)
+        if featured is None:
+            featured = self._cacheFeaturedSpeaker(
+                ndb.Key(urlsafe=request.websafeConferenceKey))
+        return StringMessage(data=featured)
 
 
 
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""converters.py
+
+Udacity conference server-side Python App Engine entity to ProtoRPC
+message converters
+
+A copy function is built once per (model, message) pair when the pair is
+registered: the field list, the codec for each field and whether the
+message needs check_initialized() are all worked out up front, so a
+conversion is a straight run over a precomputed plan.
+
+"""
+
+from google.appengine.ext import ndb
+from protorpc import messages
+
+from models import Conference, ConferenceForm
+from models import Profile, ProfileForm
+from models import Session, SessionForm
+from models import Speaker, SpeakerForm
+
+
+def dateCodec(value):
+    """Date/Time property to string."""
+    return str(value) if value is not None else None
+
+
+def enumCodec(enum_type):
+    """Enum name stored as a string to that Enum's value."""
+    def codec(value):
+        return getattr(enum_type, value) if value else None
+    return codec
+
+
+def identityCodec(value):
+    return value
+
+
+_REGISTRY = {}
+
+
+def _codecFor(prop, field):
+    if isinstance(prop, (ndb.DateProperty, ndb.TimeProperty)):
+        return dateCodec
+    if isinstance(field, messages.EnumField):
+        return enumCodec(field.type)
+    return identityCodec
+
+
+def register(model, message, key_field=None, codecs=None):
+    """Build and register the copy function for model -> message.
+
+    Args:
+        key_field: message field that receives the entity's urlsafe key.
+        codecs: {field name: codec} overriding the codec picked from the
+            property and field types.
+    """
+    codecs = codecs or {}
+    properties = model._properties
+    full_plan = tuple(
+        (field.name, codecs.get(field.name) or
+                     _codecFor(properties[field.name], field))
+        for field in message.all_fields() if field.name in properties)
+    needs_check = any(field.required for field in message.all_fields())
+    # field mask -> trimmed plan, built on first use of each mask
+    masked_plans = {}
+
+    def planFor(fields):
+        if fields is None:
+            return full_plan, key_field
+        if fields not in masked_plans:
+            masked_plans[fields] = (
+                tuple(step for step in full_plan if step[0] in fields),
+                key_field if key_field in fields else None)
+        return masked_plans[fields]
+
+    def copy(entity, fields=None, **extra):
+        """Copy entity to message; fields, a frozenset, limits the
+        fields read and set (projected entities only have some).
+        """
+        plan, plan_key_field = planFor(fields)
+        values = dict((name, codec(getattr(entity, name)))
+                      for name, codec in plan)
+        if plan_key_field:
+            values[plan_key_field] = entity.key.urlsafe()
+        for name, value in extra.items():
+            if value is not None and (fields is None or name in fields):
+                values[name] = value
+        form = message(**values)
+        if needs_check:
+            form.check_initialized()
+        return form
+
+    _REGISTRY[(model, message)] = copy
+    return copy
+
+
+def toForm(entity, message, **extra):
+    """Convert one entity to message; extra sets additional fields."""
+    return _REGISTRY[(type(entity), message)](entity, **extra)
+
+
+def toForms(entities, message, extra=None, fields=None):
+    """Convert a list of entities of one model to messages.
+
+    Args:
+        extra: optional function of an entity returning additional
+            field values for its message.
+        fields: optional frozenset of message fields to fill.
+    """
+    if not entities:
+        return []
+    copy = _REGISTRY[(type(entities[0]), message)]
+    if extra is None:
+        return [copy(entity, fields) for entity in entities]
+    return [copy(entity, fields, **extra(entity)) for entity in entities]
+
+
+register(Conference, ConferenceForm, key_field='websafeKey')
+register(Session, SessionForm, key_field='websafeSessionKey')
+register(Profile, ProfileForm)
+register(Speaker, SpeakerForm)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""feed.py
+
+Udacity conference server-side Python App Engine materialized feed of
+upcoming conferences
+
+The conferences starting today or later, soonest first, are kept as
+rendered ConferenceForm fields in the single UpcomingFeed entity, so
+the feed is served from one read of it -- from the instance cache or
+memcache once warm. Conference writes and seat reconciles schedule a
+patch of the one conference they changed on the feed queue, which runs
+one task at a time so patches never contend; the announcement cron
+queues a trim there too, which drops conferences that have started and
+rebuilds a feed that had to be truncated at MAX_FEED_ITEMS.
+
+"""
+
+import json
+import time
+from datetime import date
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+from cache import LRUCache
+from instrumentation import transactional
+from models import Conference
+from models import ConferenceForm
+from models import UpcomingFeed
+import converters
+
+
+FEED_KEY = ndb.Key(UpcomingFeed, 'upcoming')
+MAX_FEED_ITEMS = 1000
+FEED_FIELDS = frozenset(['websafeKey', 'name', 'city', 'topics', 'startDate',
+    'endDate', 'maxAttendees', 'seatsAvailable', 'organizerDisplayName'])
+MEMCACHE_FEED_KEY = 'UPCOMING_FEED'
+FEED_LOCAL_TTL = 30         # seconds an instance reuses its copy
+FEED_QUEUE = 'feed'
+PATCH_TASK_URL = '/tasks/patch_feed'
+PATCH_DELAY = 5             # seconds; one patch per conference per window
+
+FEED_CACHE = LRUCache(max_size=1, default_ttl=FEED_LOCAL_TTL)
+
+
+def _isUpcoming(conf):
+    return conf.startDate is not None and conf.startDate >= date.today()
+
+
+def _item(conf, prof):
+    """Return a conference's feed item: its ConferenceForm fields."""
+    form = converters.toForm(conf, ConferenceForm,
+        organizerDisplayName=getattr(prof, 'displayName', None))
+    item = json.loads(protojson.encode_message(form))
+    return dict((k, v) for k, v in item.items() if k in FEED_FIELDS)
+
+
+def _order(item):
+    return item['startDate'], item.get('name', '').lower(), item['websafeKey']
+
+
+def _publish(items):
+    """Make items the feed every instance serves."""
+    memcache.set(MEMCACHE_FEED_KEY, items)
+    FEED_CACHE.set(MEMCACHE_FEED_KEY, items)
+
+
+def schedulePatch(c_key=None):
+    """Enqueue a patch of one conference's item, or with no c_key a
+    rebuild of the whole feed, at most one per PATCH_DELAY.
+    """
+    wsck = c_key.urlsafe() if c_key else 'all'
+    try:
+        taskqueue.Queue(FEED_QUEUE).add(taskqueue.Task(
+            name='patch-feed-%s-%d' % (wsck, time.time() // PATCH_DELAY),
+            params={'websafeConferenceKey': c_key.urlsafe()} if c_key else {},
+            url=PATCH_TASK_URL,
+            countdown=PATCH_DELAY))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def scheduleTrim():
+    """Enqueue a trim of the feed, at most one per PATCH_DELAY."""
+    try:
+        taskqueue.Queue(FEED_QUEUE).add(taskqueue.Task(
+            name='trim-feed-%d' % (time.time() // PATCH_DELAY),
+            params={'trim': 'true'},
+            url=PATCH_TASK_URL))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+@transactional()
+def _patchItem(wsck, item):
+    feed = FEED_KEY.get()
+    if not feed:
+        return None
+    items = [i for i in feed.items or [] if i['websafeKey'] != wsck]
+    if item is not None:
+        items.append(item)
+        items.sort(key=_order)
+        if len(items) > MAX_FEED_ITEMS:
+            feed.full = True
+            items = items[:MAX_FEED_ITEMS]
+    feed.items = items
+    feed.put()
+    return items
+
+
+def patch(c_key):
+    """Bring one conference's item in line with the conference."""
+    conf, prof = ndb.get_multi([c_key, c_key.parent()])
+    item = _item(conf, prof) if conf and _isUpcoming(conf) else None
+    items = _patchItem(c_key.urlsafe(), item)
+    if items is None:
+        # nothing to patch yet; a partial feed would hide the rest
+        rebuild()
+    else:
+        _publish(items)
+
+
+def rebuild():
+    """Rebuild the feed from the datastore."""
+    confs = Conference.query(Conference.startDate >= date.today()) \
+                      .order(Conference.startDate) \
+                      .fetch(MAX_FEED_ITEMS + 1)
+    profiles = dict((p.key, p) for p in ndb.get_multi(
+        list(set(c.key.parent() for c in confs))) if p)
+    items = sorted((_item(c, profiles.get(c.key.parent())) for c in confs),
+                   key=_order)
+    UpcomingFeed(key=FEED_KEY, items=items[:MAX_FEED_ITEMS],
+                 full=len(items) > MAX_FEED_ITEMS).put()
+    _publish(items[:MAX_FEED_ITEMS])
+
+
+@transactional()
+def _dropStarted():
+    feed = FEED_KEY.get()
+    if not feed:
+        return None
+    today = str(date.today())
+    items = [i for i in feed.items or [] if i['startDate'] >= today]
+    if len(items) != len(feed.items or []):
+        feed.items = items
+        feed.put()
+    return feed
+
+
+def trim():
+    """Drop conferences that have started; rebuild a feed that is missing
+    or was truncated, since its tail may now have room. Runs on the feed
+    queue, through scheduleTrim(), so it never interleaves with a patch.
+    """
+    feed = _dropStarted()
+    if feed is None or feed.full:
+        rebuild()
+    else:
+        _publish(feed.items or [])
+
+
+def items():
+    """Return the feed's items, soonest first."""
+    feed_items = FEED_CACHE.get(MEMCACHE_FEED_KEY)
+    if feed_items is None:
+        feed_items = memcache.get(MEMCACHE_FEED_KEY)
+        if feed_items is None:
+            feed = FEED_KEY.get()
+            if feed is None:
+                # cold start: serve nothing until the rebuild publishes
+                schedulePatch()
+                return []
+            feed_items = feed.items or []
+            # add, not set: never overwrite a fresher copy from a patch
+            memcache.add(MEMCACHE_FEED_KEY, feed_items)
+        FEED_CACHE.set(MEMCACHE_FEED_KEY, feed_items)
+    return feed_items
+
+
+def toForm(item):
+    """Return a feed item as a ConferenceForm."""
+    return protojson.decode_message(ConferenceForm, json.dumps(item))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""idtoken.py
+
+Udacity conference server-side Python App Engine local verification of
+Google-signed ID tokens (RS256 JWTs) against a cached signing key set
+
+"""
+
+import base64
+import json
+import re
+import threading
+import time
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+
+
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+MEMCACHE_CERTS_KEY = "ID_TOKEN_CERTS"
+CLOCK_SKEW = 300            # seconds of leeway on iat/exp
+DEFAULT_CERTS_TTL = 3600    # used when the response has no max-age
+MIN_REFRESH_INTERVAL = 60   # throttle refetches caused by unknown kids
+
+
+class InvalidTokenError(Exception):
+    """The token is malformed, badly signed, expired or not for us."""
+
+
+class CertificateError(Exception):
+    """The signing key set could not be fetched."""
+
+
+def _b64decode(segment):
+    """Decode a base64url segment with its padding stripped."""
+    segment = str(segment)
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def _b64int(segment):
+    return long(_b64decode(segment).encode('hex'), 16)
+
+
+def looks_like_jwt(token):
+    """Return True if token has the three-segment shape of a JWT."""
+    return token.count('.') == 2
+
+
+class CertificateCache(object):
+    """Signing keys by key id, cached per instance and in memcache.
+
+    The set is refetched when its max-age runs out, or early when a
+    token names a key id we don't know yet (the keys have rotated).
+    fetch can be swapped for a stub endpoint.
+    """
+
+    def __init__(self, url=GOOGLE_CERTS_URL, fetch=None,
+                 memcache_key=MEMCACHE_CERTS_KEY):
+        self.url = url
+        self.fetch = fetch or urlfetch.fetch
+        self.memcache_key = memcache_key
+        self._keys = {}
+        self._expires = 0
+        self._last_fetch = 0
+        self._lock = threading.Lock()
+
+    def get_key(self, kid):
+        """Return the RSA public key for kid, refreshing if needed."""
+        now = time.time()
+        if now >= self._expires:
+            self._load(force=False)
+        key = self._keys.get(kid)
+        if key is None and now - self._last_fetch >= MIN_REFRESH_INTERVAL:
+            self._load(force=True)
+            key = self._keys.get(kid)
+        if key is None:
+            raise InvalidTokenError('Unknown signing key: %s' % kid)
+        return key
+
+    def _load(self, force):
+        with self._lock:
+            certs = None if force else memcache.get(self.memcache_key)
+            if certs is None:
+                certs = self._fetch()
+                memcache.set(self.memcache_key, certs,
+                    time=max(int(certs['expires'] - time.time()), 1))
+            self._keys = dict(
+                (jwk['kid'], RSA.construct((_b64int(jwk['n']), _b64int(jwk['e']))))
+                for jwk in certs['keys'] if jwk.get('kty') == 'RSA')
+            self._expires = certs['expires']
+
+    def _fetch(self):
+        self._last_fetch = time.time()
+        try:
+            resp = self.fetch(self.url)
+        except urlfetch.Error as e:
+            raise CertificateError('Fetching %s failed: %s' % (self.url, e))
+        if resp.status_code != 200:
+            raise CertificateError('Fetching %s returned %d'
+                % (self.url, resp.status_code))
+        # honour Cache-Control so we follow the published rotation
+        max_age = re.search(r'max-age=(\d+)',
+            resp.headers.get('Cache-Control', '') or '')
+        ttl = int(max_age.group(1)) if max_age else DEFAULT_CERTS_TTL
+        return {
+            'keys': json.loads(resp.content)['keys'],
+            'expires': time.time() + ttl,
+        }
+
+
+CERTS = CertificateCache()
+
+
+def verify_id_token(token, audiences, certs=None, now=None):
+    """Verify an ID token locally and return its claims.
+
+    Args:
+        token: the encoded JWT.
+        audiences: client ids the token may be issued to.
+        certs: a CertificateCache; defaults to Google's signing keys.
+        now: current epoch time, for callers that need a fixed clock.
+    """
+    certs = certs or CERTS
+    now = time.time() if now is None else now
+    try:
+        header_b64, payload_b64, signature_b64 = str(token).split('.')
+        header = json.loads(_b64decode(header_b64))
+        claims = json.loads(_b64decode(payload_b64))
+        signature = _b64decode(signature_b64)
+    except (ValueError, TypeError, UnicodeError):
+        raise InvalidTokenError('Malformed token')
+
+    if header.get('alg') != 'RS256':
+        raise InvalidTokenError('Unexpected algorithm: %s' % header.get('alg'))
+    key = certs.get_key(header.get('kid'))
+    digest = SHA256.new('%s.%s' % (header_b64, payload_b64))
+    if not PKCS1_v1_5.new(key).verify(digest, signature):
+        raise InvalidTokenError('Bad signature')
+
+    if claims.get('iss') not in ISSUERS:
+        raise InvalidTokenError('Unexpected issuer: %s' % claims.get('iss'))
+    if claims.get('aud') not in audiences:
+        raise InvalidTokenError('Unexpected audience: %s' % claims.get('aud'))
+    try:
+        issued, expires = int(claims['iat']), int(claims['exp'])
+    except (KeyError, TypeError, ValueError):
+        raise InvalidTokenError('Missing iat/exp')
+    if issued > now + CLOCK_SKEW:
+        raise InvalidTokenError('Token used too early')
+    if expires < now - CLOCK_SKEW:
+        raise InvalidTokenError('Token expired')
+    if not claims.get('sub'):
+        raise InvalidTokenError('Missing subject')
+    return claims
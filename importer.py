@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+"""importer.py
+
+Udacity conference server-side Python App Engine bulk importer for
+historical conferences and sessions
+
+An uploaded CSV or JSON-lines file is split into ImportChunks under an
+ImportJob, and each chunk is written by its own task on the import
+queue with a few put_multi calls. Rows are keyed deterministically, so
+a chunk that is run again overwrites its own entities rather than
+duplicating them, and an interrupted job is resumed by re-enqueueing
+the chunks that aren't done yet. Imports bypass the API, so no
+confirmation emails are sent.
+
+"""
+
+import csv
+import json
+import logging
+from StringIO import StringIO
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+from protorpc import messages
+
+import autocomplete
+import feed
+from conference import ConferenceApi
+from conference import CONFERENCE_GENERATION
+from conference import _invalidateConferences
+from conference import _isNearlySoldOut
+from conference import _conferenceFromData
+from conference import _sessionFromData
+from models import Conference, ConferenceForm
+from models import ImportChunk
+from models import ImportJob
+from models import Profile
+from models import Session, SessionForm
+import search
+import speakers
+
+
+CHUNK_SIZE = 200
+IMPORT_QUEUE = 'import'
+IMPORT_TASK_URL = '/tasks/import_chunk'
+TASKS_PER_ADD = 100         # taskqueue.Queue.add() batch limit
+FORMATS = ('csv', 'jsonl')
+LIST_SEPARATOR = ';'        # between values of a repeated field in CSV
+MAX_ERRORS_PER_CHUNK = 50
+
+# the message each kind's rows are shaped like
+ROW_MESSAGES = {'Conference': ConferenceForm, 'Session': SessionForm}
+
+
+class ImportDataError(ValueError):
+    """An upload or row that can't be imported."""
+
+
+def parseRows(body, fmt):
+    """Return the rows of an upload as a list of dicts."""
+    if fmt == 'csv':
+        return [dict((name.decode('utf-8'), value.decode('utf-8'))
+                     for name, value in row.items() if name and value)
+                for row in csv.DictReader(StringIO(body))]
+    if fmt == 'jsonl':
+        rows = []
+        for number, line in enumerate(body.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                raise ImportDataError('line %d is not valid JSON' % number)
+            if not isinstance(row, dict):
+                raise ImportDataError('line %d is not a JSON object' % number)
+            rows.append(row)
+        return rows
+    raise ImportDataError('format must be one of %s' % ', '.join(FORMATS))
+
+
+def _rowData(row, message):
+    """Coerce a row's values to the types of message's fields."""
+    data = {}
+    for field in message.all_fields():
+        value = row.get(field.name)
+        if value in (None, ''):
+            continue
+        if field.repeated and not isinstance(value, list):
+            value = [v.strip() for v in unicode(value).split(LIST_SEPARATOR)
+                     if v.strip()]
+        elif isinstance(field, messages.IntegerField):
+            value = int(value)
+        elif isinstance(field, messages.FloatField):
+            value = float(value)
+        data[field.name] = value
+    return data
+
+
+def _rowId(row, job_id, number):
+    """Return a row's key id: its own 'id' column, else its position."""
+    if row.get('id') not in (None, ''):
+        return unicode(row['id'])
+    return u'%d-%d' % (job_id, number)
+
+
+def createJob(kind, fmt, body):
+    """Split an upload into a new ImportJob's chunks and enqueue them.
+
+    Returns the job.
+    """
+    if kind not in ROW_MESSAGES:
+        raise ImportDataError(
+            'kind must be one of %s' % ', '.join(sorted(ROW_MESSAGES)))
+    rows = parseRows(body, fmt)
+    chunks = [rows[i:i + CHUNK_SIZE] for i in range(0, len(rows), CHUNK_SIZE)]
+    job = ImportJob(kind=kind, format=fmt, numRows=len(rows),
+                    numChunks=len(chunks))
+    job.put()
+    ndb.put_multi([ImportChunk(id=number, parent=job.key, rows=chunk_rows)
+                   for number, chunk_rows in enumerate(chunks, 1)])
+    enqueueChunks(job.key, range(1, len(chunks) + 1))
+    return job
+
+
+def enqueueChunks(job_key, numbers):
+    """Add one import task per chunk number of a job."""
+    tasks = [taskqueue.Task(url=IMPORT_TASK_URL,
+                            params={'job': job_key.id(), 'chunk': number})
+             for number in numbers]
+    queue = taskqueue.Queue(IMPORT_QUEUE)
+    for i in range(0, len(tasks), TASKS_PER_ADD):
+        queue.add(tasks[i:i + TASKS_PER_ADD])
+
+
+def resumeJob(job_key):
+    """Re-enqueue the chunks of a job that haven't been written.
+
+    Returns how many were enqueued.
+    """
+    pending = ImportChunk.query(ImportChunk.done == False,
+                                ancestor=job_key).fetch(keys_only=True)
+    enqueueChunks(job_key, [k.id() for k in pending])
+    return len(pending)
+
+
+def jobStatus(job_key):
+    """Return a JSON-able progress report for a job."""
+    job = job_key.get()
+    if not job:
+        return None
+    # written chunks drop their rows, so they are cheap to load
+    done = ImportChunk.query(ImportChunk.done == True, ancestor=job_key).fetch()
+    return {
+        'job': job_key.id(),
+        'kind': job.kind,
+        'rows': job.numRows,
+        'chunks': job.numChunks,
+        'chunksDone': len(done),
+        'written': sum(c.written for c in done),
+        'errors': [e for c in done for e in c.errors],
+    }
+
+
+def _buildConferences(rows, job_id, first_number):
+    """Return (conferences, errors) for Conference rows."""
+    conferences, errors = [], []
+    for number, row in enumerate(rows, first_number):
+        try:
+            data = _rowData(row, ConferenceForm)
+            for name in ('websafeKey', 'organizerDisplayName', 'month'):
+                data.pop(name, None)
+            if not data.get('name') or not data.get('organizerUserId'):
+                raise ImportDataError("'name' and 'organizerUserId' are required")
+            c_key = ndb.Key(Profile, data['organizerUserId'],
+                            Conference, _rowId(row, job_id, number))
+            conferences.append(_conferenceFromData(data, c_key))
+        except (ValueError, TypeError, datastore_errors.BadValueError) as e:
+            errors.append('row %d: %s' % (number, e))
+    return conferences, errors
+
+
+def _conferenceKeyOf(row):
+    """Return the key of the conference a Session row belongs to."""
+    if row.get('websafeConferenceKey'):
+        return ndb.Key(urlsafe=row['websafeConferenceKey'])
+    if row.get('organizerUserId') and row.get('conferenceId'):
+        return ndb.Key(Profile, row['organizerUserId'],
+                       Conference, unicode(row['conferenceId']))
+    raise ImportDataError("'websafeConferenceKey', or 'organizerUserId' and "
+                          "'conferenceId', are required")
+
+
+def _buildSessions(rows, job_id, first_number):
+    """Return (sessions, errors) for Session rows."""
+    # look up every row's conference in one batch
+    c_keys = []
+    for row in rows:
+        try:
+            c_keys.append(_conferenceKeyOf(row))
+        except (ValueError, TypeError, ProtocolBufferDecodeError,
+                datastore_errors.BadValueError) as e:
+            c_keys.append(e)
+    wanted = list(set(k for k in c_keys if isinstance(k, ndb.Key)))
+    conferences = dict(zip(wanted, ndb.get_multi(wanted)))
+
+    sessions, errors = [], []
+    for number, (row, c_key) in enumerate(zip(rows, c_keys), first_number):
+        try:
+            if isinstance(c_key, Exception):
+                raise c_key
+            conf = conferences.get(c_key)
+            if not conf:
+                raise ImportDataError('no such conference')
+            data = _rowData(row, SessionForm)
+            if not data.get('sessionName'):
+                raise ImportDataError("'sessionName' is required")
+            session = _sessionFromData(data, conf)
+            session.key = ndb.Key(Session, _rowId(row, job_id, number),
+                                  parent=c_key)
+            sessions.append(session)
+        except (ValueError, TypeError, ProtocolBufferDecodeError,
+                datastore_errors.BadValueError) as e:
+            errors.append('row %d: %s' % (number, e))
+    return sessions, errors
+
+
+def _writeWithPostings(entities):
+    """put_multi entities with their keyword postings, dropping postings
+    left by an earlier version of any that already existed.
+
+    Returns the earlier versions, with None for new entities.
+    """
+    olds = ndb.get_multi([e.key for e in entities])
+    existing = [e for e, old in zip(entities, olds) if old]
+    postings = [p for e in entities for p in search.postingsFor(e)]
+    stale = [k for e in existing
+             for k in search.stalePostingKeys(e, search.postingsFor(e))]
+    ndb.put_multi(entities + postings)
+    if stale:
+        ndb.delete_multi(stale)
+    return olds
+
+
+def _afterConferences(conferences):
+    """Refresh what the API derives from conferences."""
+    CONFERENCE_GENERATION.bump()
+    feed.schedulePatch()
+    _invalidateConferences([c.key.urlsafe() for c in conferences])
+    # add or remove every one, so a re-import that raises a conference's
+    # seats takes it out of the set
+    ConferenceApi._setNearlySoldOut(dict(
+        (conf.key.urlsafe(),
+         conf.name if _isNearlySoldOut(conf.seatsAvailable) else None)
+        for conf in conferences))
+
+
+def _afterSessions(sessions):
+    """Refresh what the API derives from sessions."""
+    speakers.indexSessions(sessions)
+    for c_key in set(s.key.parent() for s in sessions):
+        speakers.recountConference(c_key)
+        ConferenceApi._cacheFeaturedSpeaker(c_key)
+
+
+def runChunk(job_id, number):
+    """Write one chunk of a job, unless it has been written already."""
+    job_key = ndb.Key(ImportJob, job_id)
+    job, chunk = ndb.get_multi([job_key,
+                                ndb.Key(ImportChunk, number, parent=job_key)])
+    if not job or not chunk or chunk.done:
+        return
+    first_number = (number - 1) * CHUNK_SIZE + 1
+    if job.kind == 'Conference':
+        entities, errors = _buildConferences(chunk.rows, job_id, first_number)
+        after = _afterConferences
+    else:
+        entities, errors = _buildSessions(chunk.rows, job_id, first_number)
+        after = _afterSessions
+    if entities:
+        olds = _writeWithPostings(entities)
+        after(entities)
+        autocomplete.enqueue(*autocomplete.changes(zip(olds, entities)))
+    if errors:
+        logging.warning('Import %d chunk %d: %d bad rows', job_id, number,
+                        len(errors))
+    # the rows aren't needed once written
+    chunk.done = True
+    chunk.rows = None
+    chunk.written = len(entities)
+    chunk.errors = errors[:MAX_ERRORS_PER_CHUNK]
+    chunk.put()
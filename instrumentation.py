@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+
+"""instrumentation.py
+
+Udacity conference server-side Python App Engine per-request RPC and
+latency instrumentation
+
+While an instrumented endpoint method or handler runs, apiproxy hooks
+charge every API call it makes to it: calls and time per RPC type,
+datastore entities read and memcache hits and misses. Each request is
+logged as one JSON line, and its latency bucket and totals are added to
+one counter blob per time window, keyed by method, which report() sums
+over the most recent windows into a rolling histogram.
+
+With TRACE_SAMPLE_RATE set, a sample of instrumented calls is also
+logged as "trace" lines -- method, request message, user pseudonym and
+timing, never the bearer token -- for benchmarks/trace_replay.py.
+
+Transactions run through transactional() are tracked the same way:
+attempts, Commit RPC time, failures and the entity groups they touched,
+so transactionReport() can rank the hottest entity groups.
+
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from protorpc import messages
+from protorpc import protojson
+
+from cache import CounterBlobs
+from settings import TRACE_SAMPLE_RATE
+
+
+WINDOW = 300                # seconds per histogram window
+REPORT_WINDOWS = 12         # windows summed by report(), i.e. an hour
+MAX_REPORT_WINDOWS = 288    # a day
+# upper bounds, in ms, of the latency histogram buckets
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# RPC types aggregated per method; per-call detail is in the log line
+RPC_SERVICES = ('datastore_v3', 'memcache', 'urlfetch', 'taskqueue', 'mail')
+LOG_PREFIX = 'rpcstats'
+TRACE_LOG_PREFIX = 'trace'
+
+MAX_GROUPS_PER_WINDOW = 500     # entity groups tracked fleet-wide per window
+HOT_GROUPS = 20
+
+_METRIC_NAMES = (('calls', 'errors', 'ms', 'entities', 'memcache_hit',
+                  'memcache_miss') +
+                 tuple('le_%d' % edge for edge in LATENCY_BUCKETS) +
+                 ('le_inf',) +
+                 tuple('rpc.%s' % s for s in RPC_SERVICES + ('other',)) +
+                 tuple('rpc_ms.%s' % s for s in RPC_SERVICES + ('other',)))
+_TXN_METRIC_NAMES = ('runs', 'attempts', 'failed', 'commit_ms')
+
+METRICS = CounterBlobs('rpcstats', expiry=(MAX_REPORT_WINDOWS + 1) * WINDOW)
+# per window, one blob of transaction names and one of entity groups
+TXN_METRICS = CounterBlobs('txnstats',
+    expiry=(MAX_REPORT_WINDOWS + 1) * WINDOW,
+    max_names=MAX_GROUPS_PER_WINDOW * len(_TXN_METRIC_NAMES))
+_state = threading.local()
+
+
+class RequestStats(object):
+    """API usage of one instrumented request."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.rpcs = defaultdict(int)
+        self.rpc_ms = defaultdict(float)
+        self.entities = 0
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+        self.started = {}   # id(request) -> time the RPC was made
+
+
+class TransactionStats(object):
+    """Attempts, commit time and entity groups of one transaction."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.attempts = 0
+        self.commit_ms = 0.0
+        self.groups = set()
+        self.started = {}   # id(request) -> time the Commit was made
+
+
+def _groupOf(reference):
+    """Return the root of a datastore Reference as "Kind:id"."""
+    root = reference.path().element(0)
+    return '%s:%s' % (root.type(),
+                      root.name() if root.has_name() else root.id())
+
+
+def _preCallTransaction(txn, call, request):
+    if call == 'BeginTransaction':
+        txn.attempts += 1
+    elif call == 'Commit':
+        txn.started[id(request)] = time.time()
+    elif call == 'Get' and request.has_transaction():
+        txn.groups.update(_groupOf(key) for key in request.key_list())
+    elif call == 'Put' and request.has_transaction():
+        txn.groups.update(_groupOf(e.key()) for e in request.entity_list())
+    elif call == 'Delete' and request.has_transaction():
+        txn.groups.update(_groupOf(key) for key in request.key_list())
+    elif call == 'RunQuery' and request.has_transaction():
+        txn.groups.add(_groupOf(request.ancestor()))
+
+
+def _preCall(service, call, request, response):
+    txn = getattr(_state, 'txn', None)
+    if txn is not None and service == 'datastore_v3':
+        _preCallTransaction(txn, call, request)
+    stats = getattr(_state, 'stats', None)
+    if stats is None:
+        return
+    stats.rpcs['%s.%s' % (service, call)] += 1
+    stats.started[id(request)] = time.time()
+
+
+def _postCall(service, call, request, response):
+    txn = getattr(_state, 'txn', None)
+    if txn is not None and call == 'Commit':
+        started = txn.started.pop(id(request), None)
+        if started is not None:
+            txn.commit_ms += (time.time() - started) * 1000
+    stats = getattr(_state, 'stats', None)
+    if stats is None:
+        return
+    started = stats.started.pop(id(request), None)
+    if started is not None:
+        # from issue to completion, so overlapping async RPCs overlap here
+        stats.rpc_ms['%s.%s' % (service, call)] += (time.time() - started) * 1000
+    if service == 'datastore_v3':
+        if call == 'Get':
+            stats.entities += sum(1 for e in response.entity_list()
+                                  if e.has_entity())
+        elif call in ('RunQuery', 'Next'):
+            stats.entities += response.result_size()
+    elif service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        stats.memcache_hits += hits
+        stats.memcache_misses += request.key_size() - hits
+
+
+def _installHooks():
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append('instrumentation', _preCall)
+    apiproxy.GetPostCallHooks().Append('instrumentation', _postCall)
+
+_installHooks()
+
+
+def _bucket(ms):
+    for edge in LATENCY_BUCKETS:
+        if ms <= edge:
+            return 'le_%d' % edge
+    return 'le_inf'
+
+
+def _record(stats, wall_ms, error):
+    """Log a finished request and add it to its method's counters."""
+    logging.info('%s %s', LOG_PREFIX, json.dumps({
+        'name': stats.name,
+        'ms': round(wall_ms, 1),
+        # roughly the Python-side work, such as copying forms
+        'non_rpc_ms': round(max(wall_ms - sum(stats.rpc_ms.values()), 0), 1),
+        'error': error,
+        'rpcs': stats.rpcs,
+        'rpc_ms': dict((rpc, round(ms, 1)) for rpc, ms in stats.rpc_ms.items()),
+        'entities': stats.entities,
+        'memcache_hit': stats.memcache_hits,
+        'memcache_miss': stats.memcache_misses,
+    }, sort_keys=True))
+
+    deltas = defaultdict(int, {
+        'calls': 1,
+        'errors': 1 if error else 0,
+        'ms': int(round(wall_ms)),
+        _bucket(wall_ms): 1,
+        'entities': stats.entities,
+        'memcache_hit': stats.memcache_hits,
+        'memcache_miss': stats.memcache_misses,
+    })
+    for rpc, count in stats.rpcs.items():
+        service = rpc.split('.', 1)[0]
+        if service not in RPC_SERVICES:
+            service = 'other'
+        deltas['rpc.%s' % service] += count
+        deltas['rpc_ms.%s' % service] += int(round(stats.rpc_ms.get(rpc, 0)))
+    METRICS.incr_multi(str(int(stats.start // WINDOW)),
+                       dict(('%s|%s' % (stats.name, metric), value)
+                            for metric, value in deltas.items() if value))
+
+
+def measure(name, fn, *args, **kwargs):
+    """Call fn, recording its API usage under name.
+
+    Calls made while another measurement is running belong to that one.
+    """
+    if getattr(_state, 'stats', None) is not None:
+        return fn(*args, **kwargs)
+    stats = _state.stats = RequestStats(name)
+    error = None
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        # stop charging RPCs first; recording may itself flush counters
+        _state.stats = None
+        _record(stats, (time.time() - stats.start) * 1000, error)
+
+
+def _userPseudonym():
+    """Return a stable stand-in for the caller's bearer token."""
+    auth = os.getenv('HTTP_AUTHORIZATION') or ''
+    return hashlib.sha256('trace:' + auth.split()[-1]).hexdigest()[:16] \
+        if auth.strip() else None
+
+
+def _traced(name, fn, args, kwargs):
+    """measure() a call, then log it as a trace line for replay."""
+    request = args[-1] if args and isinstance(args[-1], messages.Message) else None
+    start = time.time()
+    error = None
+    try:
+        return measure(name, fn, *args, **kwargs)
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        logging.info('%s %s', TRACE_LOG_PREFIX, json.dumps({
+            't': start,
+            'method': name,
+            'request': json.loads(protojson.encode_message(request))
+                       if request is not None else None,
+            'user': _userPseudonym(),
+            'ms': round((time.time() - start) * 1000, 1),
+            'error': error,
+        }, sort_keys=True))
+
+
+def instrumented(fn):
+    """Decorator measuring each call of fn under its name, and tracing a
+    TRACE_SAMPLE_RATE sample of them.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if TRACE_SAMPLE_RATE and random.random() < TRACE_SAMPLE_RATE:
+            return _traced(fn.__name__, fn, args, kwargs)
+        return measure(fn.__name__, fn, *args, **kwargs)
+    return wrapper
+
+
+def instrumentApp(app):
+    """Measure every request a webapp2 app dispatches, by route."""
+    routes = set(route.template for route in app.router.match_routes)
+
+    def dispatcher(router, request, response):
+        name = request.path if request.path in routes else 'unrouted'
+        return measure(name, router.default_dispatcher, request, response)
+
+    app.router.set_dispatcher(dispatcher)
+    return app
+
+
+def _percentile(histogram, calls, q):
+    """Upper bound of the bucket holding the q-th fraction of calls."""
+    seen = 0
+    for edge in LATENCY_BUCKETS:
+        seen += histogram['le_%d' % edge]
+        if seen >= q * calls:
+            return edge
+    return None     # beyond the largest bucket
+
+
+def report(windows=REPORT_WINDOWS, now=None):
+    """Return fleet-wide stats per method over the last windows."""
+    current = int((now or time.time()) // WINDOW)
+    window_ids = range(current - windows + 1, current + 1)
+    blobs = METRICS.fleet_snapshot([str(window) for window in window_ids])
+    totals = defaultdict(lambda: defaultdict(int))
+    for values in blobs.values():
+        for key, value in values.items():
+            name, metric = key.rsplit('|', 1)
+            totals[name][metric] += value
+
+    result = {}
+    for name, total in totals.items():
+        calls = total['calls']
+        if not calls:
+            continue
+        histogram = dict((metric, total[metric]) for metric in _METRIC_NAMES
+                         if metric.startswith('le_'))
+        result[name] = {
+            'calls': calls,
+            'errors': total['errors'],
+            'mean_ms': float(total['ms']) / calls,
+            'p50_ms': _percentile(histogram, calls, 0.50),
+            'p95_ms': _percentile(histogram, calls, 0.95),
+            'p99_ms': _percentile(histogram, calls, 0.99),
+            'histogram': histogram,
+            'entities_per_call': float(total['entities']) / calls,
+            'memcache_hit': total['memcache_hit'],
+            'memcache_miss': total['memcache_miss'],
+            'rpcs_per_call': dict((s, float(total['rpc.%s' % s]) / calls)
+                                  for s in RPC_SERVICES + ('other',)
+                                  if total['rpc.%s' % s]),
+            'rpc_ms_per_call': dict((s, float(total['rpc_ms.%s' % s]) / calls)
+                                    for s in RPC_SERVICES + ('other',)
+                                    if total['rpc.%s' % s]),
+        }
+    return {'window_seconds': WINDOW, 'windows': windows, 'methods': result}
+
+
+# - - - Transactions - - - - - - - - - - - - - - - - - - - - -
+
+def _recordTransaction(txn, failed):
+    """Log a contended transaction and add it to the counters."""
+    if txn.attempts > 1 or failed:
+        logging.warning('%s %s', LOG_PREFIX, json.dumps({
+            'transaction': txn.name,
+            'attempts': txn.attempts,
+            'failed': failed,
+            'commit_ms': round(txn.commit_ms, 1),
+            'groups': sorted(txn.groups),
+        }, sort_keys=True))
+
+    window = int(txn.start // WINDOW)
+    values = {
+        'runs': 1,
+        'attempts': txn.attempts,
+        'failed': 1 if failed else 0,
+        'commit_ms': int(round(txn.commit_ms)),
+    }
+    TXN_METRICS.incr_multi('%d.t' % window,
+                           dict(('%s|%s' % (txn.name, metric), value)
+                                for metric, value in values.items() if value))
+    if txn.groups:
+        TXN_METRICS.incr_multi('%d.g' % window,
+                               dict(('%s|%s' % (group, metric), value)
+                                    for group in txn.groups
+                                    for metric, value in values.items()
+                                    if value))
+
+
+def transactional(**options):
+    """Like ndb.transactional(**options), also recording each run's
+    attempts, commit time, failure and entity groups under the
+    function's name.
+    """
+    def decorator(fn):
+        txn_fn = ndb.transactional(**options)(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # a transaction joined by another is part of the outer one
+            if getattr(_state, 'txn', None) is not None:
+                return txn_fn(*args, **kwargs)
+            txn = _state.txn = TransactionStats(fn.__name__)
+            failed = False
+            try:
+                return txn_fn(*args, **kwargs)
+            except datastore_errors.TransactionFailedError:
+                failed = True
+                raise
+            finally:
+                _state.txn = None
+                _recordTransaction(txn, failed)
+        return wrapper
+    return decorator
+
+
+def _transactionTotals(totals):
+    runs = totals['runs']
+    return {
+        'runs': runs,
+        'attempts': totals['attempts'],
+        'retries': totals['attempts'] - runs,
+        'failed': totals['failed'],
+        'mean_commit_ms': float(totals['commit_ms']) / runs,
+    }
+
+
+def transactionReport(windows=REPORT_WINDOWS, limit=HOT_GROUPS, now=None):
+    """Return fleet-wide stats per transaction and the limit entity
+    groups with the most retries over the last windows.
+    """
+    current = int((now or time.time()) // WINDOW)
+    window_ids = range(current - windows + 1, current + 1)
+    blobs = TXN_METRICS.fleet_snapshot(['%d.%s' % (window, scope)
+                                        for window in window_ids
+                                        for scope in ('t', 'g')])
+
+    totals = {'t': defaultdict(lambda: defaultdict(int)),
+              'g': defaultdict(lambda: defaultdict(int))}
+    for blob, values in blobs.items():
+        scope = blob.rsplit('.', 1)[1]
+        for key, value in values.items():
+            name, metric = key.rsplit('|', 1)
+            totals[scope][name][metric] += value
+
+    transactions = dict((name, _transactionTotals(t))
+                        for name, t in totals['t'].items() if t['runs'])
+    groups = [dict(_transactionTotals(g), group=group)
+              for group, g in totals['g'].items() if g['runs']]
+    groups.sort(key=lambda g: (-g['retries'], -g['failed'], -g['attempts']))
+    return {'window_seconds': WINDOW, 'windows': windows,
+            'transactions': transactions, 'hottest_groups': groups[:limit]}
@@ -12,18 +12,45 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+import time
+
 import webapp2
 from google.appengine.api import app_identity
+from google.appengine.api import datastore_errors
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from protorpc import protojson
 from conference import ConferenceApi
-from conference import SAME_SPEAKER_SESSION
-from google.appengine.api import memcache
+from conference import CONFERENCE_GENERATION
+from conference import _activeDays
+from conference import _wishlistKey
+from cache import stats_snapshot
+from models import Conference
+from models import ConferenceForm
+from models import ImportJob
+from models import Session
+from models import SessionForm
+from models import Wishlist
+import autocomplete
+import converters
+import feed
+import importer
+import instrumentation
+from instrumentation import transactional
+import search
+import seats
+import speakers
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
-        """Set Announcement in Memcache."""
+        """Check the incrementally kept Announcement against the datastore,
+        and trim started conferences from the upcoming feed."""
         ConferenceApi._cacheAnnouncement()
+        feed.scheduleTrim()
         self.response.set_status(204)
 
 
@@ -42,15 +69,343 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
 
 class MemcacheFeaturedSpeaker(webapp2.RequestHandler):
     def post(self):
+        """Set a conference's featured speaker in memcache."""
+        ConferenceApi._cacheFeaturedSpeaker(
+            ndb.Key(urlsafe=self.request.get('websafeConferenceKey')))
+
+
+class IndexSpeakersHandler(webapp2.RequestHandler):
+    def post(self):
+        """Add new sessions to the speaker directory."""
+        s_keys = [ndb.Key(urlsafe=wssk)
+                  for wssk in self.request.get_all('websafeSessionKey')]
+        speakers.indexSessions([s for s in ndb.get_multi(s_keys) if s])
+
+
+class IndexSearchHandler(webapp2.RequestHandler):
+    def post(self):
+        """Write keyword postings for new sessions."""
+        s_keys = [ndb.Key(urlsafe=wssk)
+                  for wssk in self.request.get_all('websafeSessionKey')]
+        search.indexEntities([s for s in ndb.get_multi(s_keys) if s], new=True)
+
+
+class IndexAutocompleteHandler(webapp2.RequestHandler):
+    def post(self):
+        """Apply added and removed entries to the autocomplete shards."""
+        autocomplete.applyChanges(self.request.get('change'),
+                                  self.request.get_all('add'),
+                                  self.request.get_all('remove'))
+
+
+class PatchFeedHandler(webapp2.RequestHandler):
+    def post(self):
+        """Patch one conference into the upcoming feed, trim it or
+        rebuild it."""
+        wsck = self.request.get('websafeConferenceKey')
+        if self.request.get('trim'):
+            feed.trim()
+        elif wsck:
+            feed.patch(ndb.Key(urlsafe=wsck))
+        else:
+            feed.rebuild()
+
+
+class ImportHandler(webapp2.RequestHandler):
+    def post(self):
+        """Start an import of an uploaded CSV/JSONL file of
+        conferences or sessions."""
+        upload = self.request.POST.get('file')
+        body = upload.value if hasattr(upload, 'value') else self.request.body
+        try:
+            job = importer.createJob(self.request.get('kind'),
+                self.request.get('format', 'csv'), body)
+        except importer.ImportDataError as e:
+            self.response.set_status(400)
+            self.response.write(str(e))
+            return
+        self.response.set_status(202)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'job': job.key.id(),
+            'rows': job.numRows, 'chunks': job.numChunks}))
+
+    def get(self):
+        """Report an import's progress; with resume=1, re-enqueue
+        the chunks that haven't been written."""
+        try:
+            job_key = ndb.Key(ImportJob, int(self.request.get('job')))
+        except ValueError:
+            self.abort(400)
+        if self.request.get('resume'):
+            importer.resumeJob(job_key)
+        status = importer.jobStatus(job_key)
+        if status is None:
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(status, sort_keys=True))
+
+
+class ImportChunkHandler(webapp2.RequestHandler):
+    def post(self):
+        """Write one chunk of an import."""
+        importer.runChunk(int(self.request.get('job')),
+            int(self.request.get('chunk')))
+
+
+EXPORT_BATCH_SIZE = 500
+EXPORT_MAX_BYTES = 24 * 1024 * 1024     # under the 32MB response limit
+EXPORT_TIME_BUDGET = 45                 # seconds, under the 60s deadline
+
+
+class ExportHandler(webapp2.RequestHandler):
+    """Export Conferences or Sessions as newline-delimited JSON, one
+    form per line, walking the kind in batches.
+
+    A response stops at a size or time budget; it then carries an
+    X-Next-Cursor header, and passing that back as cursor continues
+    the export where it left off.
+    """
+    kinds = {'Conference': (Conference, ConferenceForm),
+             'Session': (Session, SessionForm)}
+
+    def get(self):
+        try:
+            model, message = self.kinds[self.request.get('kind')]
+            cursor = self.request.get('cursor')
+            cursor = Cursor(urlsafe=cursor) if cursor else None
+        except (KeyError, TypeError, datastore_errors.BadValueError):
+            self.abort(400)
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+
+        deadline = time.time() + EXPORT_TIME_BUDGET
+        written = 0
+        entities = model.query().iter(batch_size=EXPORT_BATCH_SIZE,
+            start_cursor=cursor, produce_cursors=True)
+        lines = []
+        for entity in entities:
+            lines.append(protojson.encode_message(
+                converters.toForm(entity, message)))
+            if len(lines) < EXPORT_BATCH_SIZE and entities.has_next():
+                continue
+            # write out each batch rather than the whole export at once
+            chunk = '\n'.join(lines) + '\n'
+            self.response.write(chunk)
+            written += len(chunk)
+            lines = []
+            if written >= EXPORT_MAX_BYTES or time.time() >= deadline:
+                if entities.has_next():
+                    self.response.headers['X-Next-Cursor'] = \
+                        entities.cursor_after().urlsafe()
+                break
+
+
+class StatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return cache hit/miss counters as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats_snapshot(), sort_keys=True))
+
+
+class RpcStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return per-method latency histograms and RPC usage as JSON."""
+        windows = self.request.get('windows')
+        windows = int(windows) if windows.isdigit() else instrumentation.REPORT_WINDOWS
+        windows = max(1, min(windows, instrumentation.MAX_REPORT_WINDOWS))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrumentation.report(windows),
+            sort_keys=True))
+
+
+class TxnStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return per-transaction retry stats and the hottest entity
+        groups as JSON."""
+        windows = self.request.get('windows')
+        windows = int(windows) if windows.isdigit() else instrumentation.REPORT_WINDOWS
+        windows = max(1, min(windows, instrumentation.MAX_REPORT_WINDOWS))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(
+            instrumentation.transactionReport(windows), sort_keys=True))
+
+
+class ReconcileSeatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Write a conference's seat shard total to seatsAvailable."""
+        conf, old_seats = seats.reconcile(
+            ndb.Key(urlsafe=self.request.get('websafeConferenceKey')))
+        if conf and conf.seatsAvailable != old_seats:
+            CONFERENCE_GENERATION.bump()
+            ConferenceApi._updateNearlySoldOut(conf.key.urlsafe(), conf.name,
+                conf.seatsAvailable, old_seats)
+            feed.schedulePatch(conf.key)
+
+
+def batchTaskHandler(task_url, query, process, start=None, done=None,
+                     batch_size=100, keys_only=False, queue_name=None):
+    """Return a handler walking query(params) in batches, one task per
+    batch chained by cursor, and passing each batch to
+    process(entities, params).
+
+    GET (under /admin/) starts a chain per params dict start() returns,
+    or one with no params; each POST to task_url handles one batch and
+    enqueues the next with the same params, or calls done(params), if
+    given, after the last batch.
+    """
+    class BatchTaskHandler(webapp2.RequestHandler):
+        def get(self):
+            """Start the task chain(s)."""
+            for params in (start() if start else [{}]):
+                taskqueue.add(params=params, url=task_url,
+                              queue_name=queue_name)
+            self.response.set_status(202)
+
+        def post(self):
+            """Process one batch, then chain the next."""
+            params = dict(self.request.POST.items())
+            cursor = params.pop('cursor', None)
+            cursor = Cursor(urlsafe=cursor) if cursor else None
+            entities, next_cursor, more = query(params).fetch_page(
+                batch_size, start_cursor=cursor, keys_only=keys_only)
+            process(entities, params)
+            if more and next_cursor:
+                params['cursor'] = next_cursor.urlsafe()
+                taskqueue.add(params=params, url=task_url,
+                              queue_name=queue_name)
+            elif done:
+                done(params)
+    return BatchTaskHandler
+
+
+@transactional()
+def _backfillActiveDays(c_key):
+    conf = c_key.get()
+    conf.activeDays = _activeDays(conf.startDate, conf.endDate)
+    conf.put()
+
+
+def _backfillActiveDaysBatch(c_keys, params):
+    """Fill in Conference.activeDays for conferences that predate it."""
+    for c_key in c_keys:
+        _backfillActiveDays(c_key)
+
+
+def _recountSpeakersBatch(c_keys, params):
+    """Rebuild the per-conference speaker counts from their sessions."""
+    for c_key in c_keys:
+        speakers.recountConference(c_key)
+        ConferenceApi._cacheFeaturedSpeaker(c_key)
+
+
+def _indexSpeakersBatch(sessions, params):
+    """Add existing sessions to the speaker directory."""
+    speakers.indexSessions(sessions)
+
+
+def _migrateWishlistsBatch(rows, params):
+    """Rewrite old auto-id Wishlist rows as keyed entries under their users."""
+    legacy = [w for w in rows if w.key.parent() is None]
+    ndb.put_multi([Wishlist(
+        key=_wishlistKey(w.userKey, w.sessionKey),
+        userName=w.userName,
+        userKey=w.userKey,
+        sessionKey=w.sessionKey,
+        sessionName=w.sessionName,
+        conferenceKey=w.sessionKey.parent()) for w in legacy])
+    ndb.delete_multi([w.key for w in legacy])
+
+
+INDEXED_MODELS = {'Conference': Conference, 'Session': Session}
+
+
+def _indexedKinds():
+    return [{'kind': kind} for kind in sorted(INDEXED_MODELS)]
+
+
+def _reindexSearchBatch(entities, params):
+    """(Re)build the keyword index postings of existing data."""
+    search.indexEntities(entities)
+
+
+def _rebuildAutocompleteBatch(entities, params):
+    """Scan existing data into the autocomplete generation being built."""
+    autocomplete.rebuildBatch(entities, int(params['generation']))
+
+
+def _finishAutocompleteKind(params):
+    autocomplete.finishKind(int(params['generation']), params['kind'])
+
+
+def _fillAutocompletePrefixesBatch(shard_keys, params):
+    """Compute the prefixes of a rebuilt autocomplete generation."""
+    autocomplete.fillPrefixes(shard_keys, int(params['generation']))
+
+
+def _activateAutocomplete(params):
+    autocomplete.activate(int(params['generation']))
+
 
-        speaker_session = self.request.get("featured_speaker")
+def _dropAutocompleteBatch(keys, params):
+    """Delete a batch of an old autocomplete generation's entities."""
+    ndb.delete_multi(keys)
 
-        memcache.set(SAME_SPEAKER_SESSION, speaker_session)
 
+ActiveDaysBackfillHandler = batchTaskHandler('/tasks/backfill_active_days',
+    lambda params: Conference.query(), _backfillActiveDaysBatch,
+    keys_only=True)
+SpeakerCountBackfillHandler = batchTaskHandler(
+    '/tasks/backfill_speaker_counts',
+    lambda params: Conference.query(), _recountSpeakersBatch,
+    keys_only=True)
+SpeakerBackfillHandler = batchTaskHandler('/tasks/backfill_speakers',
+    lambda params: Session.query(), _indexSpeakersBatch)
+WishlistMigrationHandler = batchTaskHandler('/tasks/migrate_wishlists',
+    lambda params: Wishlist.query(), _migrateWishlistsBatch)
+SearchBackfillHandler = batchTaskHandler('/tasks/backfill_search_index',
+    lambda params: INDEXED_MODELS[params['kind']].query(),
+    _reindexSearchBatch, start=_indexedKinds)
+AutocompleteBackfillHandler = batchTaskHandler('/tasks/backfill_autocomplete',
+    lambda params: INDEXED_MODELS[params['kind']].query(),
+    _rebuildAutocompleteBatch, start=autocomplete.startRebuild,
+    done=_finishAutocompleteKind, queue_name=autocomplete.QUEUE)
+AutocompletePrefixHandler = batchTaskHandler(autocomplete.PREFIX_TASK_URL,
+    lambda params: autocomplete.generationEntities(int(params['generation'])),
+    _fillAutocompletePrefixesBatch, done=_activateAutocomplete,
+    keys_only=True, queue_name=autocomplete.QUEUE)
+AutocompleteDropHandler = batchTaskHandler(autocomplete.DROP_TASK_URL,
+    lambda params: autocomplete.generationEntities(int(params['generation']),
+        params.get('kind', 'AutocompleteShard')),
+    _dropAutocompleteBatch, keys_only=True, queue_name=autocomplete.QUEUE)
 
 
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/memcache_featured_speaker', MemcacheFeaturedSpeaker),
+    ('/tasks/index_speakers', IndexSpeakersHandler),
+    ('/tasks/index_search', IndexSearchHandler),
+    ('/tasks/index_autocomplete', IndexAutocompleteHandler),
+    ('/tasks/patch_feed', PatchFeedHandler),
+    ('/tasks/import_chunk', ImportChunkHandler),
+    ('/tasks/reconcile_seats', ReconcileSeatsHandler),
+    ('/tasks/backfill_search_index', SearchBackfillHandler),
+    ('/tasks/migrate_wishlists', WishlistMigrationHandler),
+    ('/admin/stats', StatsHandler),
+    ('/admin/rpcstats', RpcStatsHandler),
+    ('/admin/txnstats', TxnStatsHandler),
+    ('/admin/import', ImportHandler),
+    ('/admin/export', ExportHandler),
+    ('/tasks/backfill_active_days', ActiveDaysBackfillHandler),
+    ('/admin/backfill_search_index', SearchBackfillHandler),
+    ('/admin/migrate_wishlists', WishlistMigrationHandler),
+    ('/admin/backfill_active_days', ActiveDaysBackfillHandler),
+    ('/tasks/backfill_speaker_counts', SpeakerCountBackfillHandler),
+    ('/admin/backfill_speaker_counts', SpeakerCountBackfillHandler),
+    ('/tasks/backfill_speakers', SpeakerBackfillHandler),
+    ('/admin/backfill_speakers', SpeakerBackfillHandler),
+    ('/tasks/backfill_autocomplete', AutocompleteBackfillHandler),
+    ('/tasks/fill_autocomplete_prefixes', AutocompletePrefixHandler),
+    ('/tasks/drop_autocomplete_generation', AutocompleteDropHandler),
+    ('/admin/backfill_autocomplete', AutocompleteBackfillHandler),
 ], debug=True)
+instrumentation.instrumentApp(app)
@@ -22,6 +22,20 @@ from google.appengine.ext import ndb
 
 
 #============Session============
+class SpeakerCount(ndb.Model):
+    """Sessions of one speaker in a conference; child of the Conference,
+    keyed by the normalized speaker name"""
+    speaker = ndb.StringProperty(indexed=False)
+    count = ndb.IntegerProperty(default=0)
+    sessionNames = ndb.StringProperty(repeated=True, indexed=False)
+
+class Speaker(ndb.Model):
+    """Speaker object, keyed by the normalized speaker name"""
+    name = ndb.StringProperty(indexed=False)
+    nameTokens = ndb.StringProperty(repeated=True)
+    sessionKeys = ndb.KeyProperty(kind='Session', repeated=True, indexed=False)
+    sessionCount = ndb.IntegerProperty(default=0, indexed=False)
+
 class Session(ndb.Model):
     """Session object"""
     sessionName = ndb.StringProperty(required=True)
@@ -51,6 +65,17 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- multiple Conference outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+class SpeakerForm(messages.Message):
+    """SpeakerForm -- Speaker outbound form message"""
+    name = messages.StringField(1)
+    sessionCount = messages.IntegerField(2)
+
+class SpeakerForms(messages.Message):
+    """SpeakerForms -- multiple Speaker outbound form message"""
+    items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 #=========above is session 
 
@@ -98,6 +123,8 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    activeDays      = ndb.DateProperty(repeated=True) # every day it runs
+    seatShards      = ndb.IntegerProperty(default=0, indexed=False) # 0: not sharded yet
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -117,6 +144,7 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -145,14 +173,24 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
+    fields = messages.StringField(4, repeated=True)
+
+class SeatShard(ndb.Model):
+    """One slice of a conference's free seats; a root entity so shards
+    of one conference can be written concurrently"""
+    seats = ndb.IntegerProperty(default=0, indexed=False)
 
 #========= Wishlist============
 class Wishlist(ndb.Model):
-    """User's Wishlist object"""
+    """User's Wishlist object; child of the user's Profile, keyed by the
+    session's urlsafe key"""
     userName = ndb.StringProperty()
     userKey = ndb.KeyProperty(kind=Profile)
     sessionName = ndb.StringProperty()
     sessionKey = ndb.KeyProperty(kind=Session)
+    conferenceKey = ndb.KeyProperty(kind=Conference)
 
 class WishlistForm(messages.Message):
     """Wishlist outbound messages"""
@@ -164,4 +202,67 @@ class ConferenceFormAndSessionForm(messages.Message):
     """Multiple Conference and Session outbound form message"""
     c_data = messages.MessageField(ConferenceForms, 1)
     s_data = messages.MessageField(SessionForms, 2)
-    
+
+#=========== Keyword search index==========
+class KeywordPosting(ndb.Model):
+    """One token of an indexed Conference/Session; child of that entity"""
+    token = ndb.StringProperty(required=True)
+    kind = ndb.StringProperty(required=True)
+    weight = ndb.IntegerProperty()
+
+#=========== Autocomplete index==========
+class AutocompleteShard(ndb.Model):
+    """Typeahead entries of one generation with a word starting with the
+    same leading characters, one of several hash buckets of them; keyed
+    "generation:lead:bucket". entries is {"field:value": number of
+    entities with it}, applied {change id: time} of recent changes"""
+    entries = ndb.JsonProperty(compressed=True)
+    applied = ndb.JsonProperty(compressed=True)
+
+class AutocompletePrefix(ndb.Model):
+    """The most common typeahead entries of one generation with a word
+    starting with a prefix, computed from AutocompleteShards; keyed
+    "generation:prefix". entries is [[field, value, count], ...], most
+    common first"""
+    entries = ndb.JsonProperty(compressed=True)
+
+class AutocompleteIndex(ndb.Model):
+    """The generation of the autocomplete index served, and the one being
+    rebuilt, if any, with the kinds already scanned into it"""
+    current = ndb.IntegerProperty(default=0, indexed=False)
+    building = ndb.IntegerProperty(indexed=False)
+    built = ndb.StringProperty(repeated=True, indexed=False)
+
+class SuggestionForm(messages.Message):
+    """SuggestionForm -- one autocomplete suggestion"""
+    field = messages.StringField(1)
+    value = messages.StringField(2)
+    count = messages.IntegerField(3)
+
+class SuggestionForms(messages.Message):
+    """SuggestionForms -- autocomplete suggestions, most common first"""
+    items = messages.MessageField(SuggestionForm, 1, repeated=True)
+
+#=========== Upcoming feed==========
+class UpcomingFeed(ndb.Model):
+    """The upcoming conferences, soonest first, as ConferenceForm field
+    dicts; full when some had to be left off the end"""
+    items = ndb.JsonProperty(compressed=True)
+    full = ndb.BooleanProperty(default=False, indexed=False)
+
+#=========== Bulk import==========
+class ImportJob(ndb.Model):
+    """One uploaded import file; parent of its ImportChunks"""
+    kind = ndb.StringProperty(required=True)
+    format = ndb.StringProperty(indexed=False)
+    numRows = ndb.IntegerProperty(indexed=False)
+    numChunks = ndb.IntegerProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+class ImportChunk(ndb.Model):
+    """A slice of an import's rows, written by one task; child of the
+    ImportJob, keyed by its 1-based position"""
+    rows = ndb.JsonProperty(compressed=True)
+    done = ndb.BooleanProperty(default=False)
+    written = ndb.IntegerProperty(default=0, indexed=False)
+    errors = ndb.StringProperty(repeated=True, indexed=False)
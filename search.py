@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""search.py
+
+Udacity conference server-side Python App Engine inverted keyword index
+over Conference and Session text fields
+
+Every indexed entity owns one KeywordPosting child per distinct token,
+so postings are written in the same entity group (and transaction) as
+the entity itself. A keyword lookup reads at most CANDIDATES_PER_TOKEN
+of each token's postings, heaviest first, side by side. A token whose
+list came back short has no other matches, so the shortest such list
+holds every candidate; when every token is that common, the candidates
+are the CANDIDATES_PER_TOKEN entities heaviest across those lists. Each
+candidate is then checked for every token's posting by key, which also
+yields its weights.
+
+"""
+
+import re
+from collections import defaultdict
+
+from google.appengine.ext import ndb
+
+from models import KeywordPosting
+
+
+# indexed fields per kind, with the weight a match in that field scores
+INDEXED_FIELDS = {
+    'Conference': {'name': 3, 'topics': 2, 'description': 1},
+    'Session': {'sessionName': 3, 'highlights': 1, 'conferenceBelongTo': 1},
+}
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MAX_TOKEN_LENGTH = 100
+CANDIDATES_PER_TOKEN = 300  # postings read per token, heaviest first
+
+
+def tokenize(text):
+    """Split text into distinct case-folded tokens."""
+    if not text:
+        return set()
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return set(t[:MAX_TOKEN_LENGTH] for t in TOKEN_RE.findall(text.lower()))
+
+
+def _entityTokens(entity):
+    """Return {token: weight} for an entity's indexed fields."""
+    weights = defaultdict(int)
+    for field, weight in INDEXED_FIELDS[entity._get_kind()].items():
+        values = getattr(entity, field, None)
+        if not isinstance(values, list):
+            values = [values]
+        tokens = set()
+        for value in values:
+            tokens |= tokenize(value)
+        for token in tokens:
+            weights[token] += weight
+    return weights
+
+
+def postingsFor(entity):
+    """Return the KeywordPosting entities for a keyed Conference/Session."""
+    kind = entity._get_kind()
+    return [KeywordPosting(
+                key=ndb.Key(KeywordPosting, token, parent=entity.key),
+                token=token, kind=kind, weight=weight)
+            for token, weight in _entityTokens(entity).items()]
+
+
+def stalePostingKeys(entity, postings):
+    """Return keys of entity's stored postings that are no longer wanted."""
+    wanted = set(p.key for p in postings)
+    # filter on kind so a Conference doesn't pick up its Sessions' postings
+    stored = KeywordPosting.query(
+        KeywordPosting.kind == entity._get_kind(),
+        ancestor=entity.key).fetch(keys_only=True)
+    return [k for k in stored if k.parent() == entity.key and k not in wanted]
+
+
+def indexEntities(entities, new=False):
+    """Write postings for entities, dropping stale ones unless new.
+
+    Safe to call inside the transaction that writes the entities.
+    """
+    postings = []
+    stale = []
+    for entity in entities:
+        entity_postings = postingsFor(entity)
+        postings.extend(entity_postings)
+        if not new:
+            stale.extend(stalePostingKeys(entity, entity_postings))
+    if stale:
+        ndb.delete_multi(stale)
+    ndb.put_multi(postings)
+
+
+@ndb.tasklet
+def search_async(kind, keyword, limit):
+    """Future for up to limit keys of kind matching every token of
+    keyword, best first.
+    """
+    tokens = sorted(tokenize(keyword))
+    if not tokens:
+        raise ndb.Return([])
+
+    # each token's heaviest postings; a short list is the whole of it,
+    # and no entity outside it can match every token
+    lists = yield [KeywordPosting.query(KeywordPosting.kind == kind,
+                                        KeywordPosting.token == token)
+                   .order(-KeywordPosting.weight)
+                   .fetch_async(CANDIDATES_PER_TOKEN,
+                                projection=[KeywordPosting.weight])
+                   for token in tokens]
+    complete = [postings for postings in lists
+                if len(postings) < CANDIDATES_PER_TOKEN]
+    if complete:
+        candidates = set(p.key.parent() for p in min(complete, key=len))
+    else:
+        # every token is common: keep the entities heaviest across them
+        heaviest = defaultdict(int)
+        for postings in lists:
+            for p in postings:
+                heaviest[p.key.parent()] += p.weight or 0
+        candidates = sorted(heaviest, key=lambda k: (-heaviest[k], k)) \
+            [:CANDIDATES_PER_TOKEN]
+    candidates = sorted(candidates)
+    if not candidates:
+        raise ndb.Return([])
+
+    # a candidate matches if it has every token's posting; sum their
+    # weights for ranking
+    postings = yield ndb.get_multi_async(
+        [ndb.Key(KeywordPosting, token, parent=candidate)
+         for candidate in candidates for token in tokens])
+    scores = {}
+    for i, candidate in enumerate(candidates):
+        row = postings[i * len(tokens):(i + 1) * len(tokens)]
+        if all(row):
+            scores[candidate] = sum(p.weight or 0 for p in row)
+
+    ranked = sorted(scores.items(), key=lambda (k, score): (-score, k))
+    raise ndb.Return([k for k, score in ranked[:limit]])
+
+
+def search(kind, keyword, limit):
+    """Return up to limit keys of kind matching every token of keyword,
+    best first.
+    """
+    return search_async(kind, keyword, limit).get_result()
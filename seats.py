@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Udacity conference server-side Python App Engine sharded seat counters
+
+A conference's free seats are split across SeatShard root entities, so
+registrations touch the user's Profile and one shard rather than the
+Conference entity group. Conference.seatsAvailable is brought back in
+line with the shards by a coalesced reconcile task, and the live total
+is cached in memcache for display.
+
+"""
+
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from instrumentation import transactional
+from models import ConflictException
+from models import SeatShard
+
+
+NUM_SHARDS = 10
+MEMCACHE_SEATS_PREFIX = "SEATS:"
+SEATS_CACHE_TTL = 300       # seconds; reconcile refreshes it anyway
+RECONCILE_DELAY = 5         # seconds; one reconcile per conference per window
+
+
+def shardKeys(c_key, num_shards):
+    """Return the SeatShard keys of a conference."""
+    wsck = c_key.urlsafe()
+    return [ndb.Key(SeatShard, '%s:%d' % (wsck, i)) for i in range(num_shards)]
+
+
+def _split(total, num_shards):
+    """Split total seats as evenly as possible over num_shards."""
+    base, extra = divmod(max(total or 0, 0), num_shards)
+    return [base + (1 if i < extra else 0) for i in range(num_shards)]
+
+
+def clearCachedTotal(c_key):
+    """Forget the cached free-seat total, after shards are reset or seeded."""
+    memcache.delete(MEMCACHE_SEATS_PREFIX + c_key.urlsafe())
+
+
+@transactional(xg=True)
+def _seedShards(c_key, num_shards):
+    conf = c_key.get()
+    if conf.seatShards:
+        return conf.seatShards
+    shards = [SeatShard(key=key, seats=seats) for key, seats in
+              zip(shardKeys(c_key, num_shards),
+                  _split(conf.seatsAvailable, num_shards))]
+    conf.seatShards = num_shards
+    ndb.put_multi(shards + [conf])
+    return num_shards
+
+
+def ensureShards(c_key, num_shards=NUM_SHARDS):
+    """Seed a conference's shards from its seatsAvailable, once.
+
+    Returns the conference's shard count.
+    """
+    num_shards = _seedShards(c_key, num_shards)
+    clearCachedTotal(c_key)
+    return num_shards
+
+
+@transactional(xg=True)
+def _registerOnShard(p_key, shard_key, wsck):
+    prof, shard = ndb.get_multi([p_key, shard_key])
+    if wsck in prof.conferenceKeysToAttend:
+        raise ConflictException(
+            "You have already registered for this conference")
+    # never take a shard below zero; the caller moves on to the next one
+    if not shard or shard.seats <= 0:
+        return False
+    prof.conferenceKeysToAttend.append(wsck)
+    shard.seats -= 1
+    ndb.put_multi([prof, shard])
+    return True
+
+
+@transactional(xg=True)
+def _unregisterOnShard(p_key, shard_key, wsck):
+    prof, shard = ndb.get_multi([p_key, shard_key])
+    if wsck not in prof.conferenceKeysToAttend:
+        return False
+    prof.conferenceKeysToAttend.remove(wsck)
+    shard = shard or SeatShard(key=shard_key)
+    shard.seats += 1
+    ndb.put_multi([prof, shard])
+    return True
+
+
+def register(p_key, c_key, num_shards):
+    """Take a seat for the user on a random shard; if that one is empty,
+    read all shards and try only those with seats left.
+
+    Raises ConflictException if already registered or sold out.
+    """
+    wsck = c_key.urlsafe()
+    keys = shardKeys(c_key, num_shards)
+    first = random.choice(keys)
+    if _registerOnShard(p_key, first, wsck):
+        return _registered(c_key)
+    shards = [s for s in ndb.get_multi(keys) if s and s.seats > 0]
+    memcache.set(MEMCACHE_SEATS_PREFIX + wsck,
+                 sum(s.seats for s in shards), time=SEATS_CACHE_TTL)
+    random.shuffle(shards)
+    for shard in shards:
+        if _registerOnShard(p_key, shard.key, wsck):
+            return _registered(c_key)
+    raise ConflictException("There are no seats available.")
+
+
+def _registered(c_key):
+    memcache.decr(MEMCACHE_SEATS_PREFIX + c_key.urlsafe())
+    scheduleReconcile(c_key)
+    return True
+
+
+def unregister(p_key, c_key, num_shards):
+    """Give the user's seat back to a random shard.
+
+    Returns False if the user wasn't registered.
+    """
+    wsck = c_key.urlsafe()
+    shard_key = random.choice(shardKeys(c_key, num_shards))
+    if not _unregisterOnShard(p_key, shard_key, wsck):
+        return False
+    memcache.incr(MEMCACHE_SEATS_PREFIX + wsck)
+    scheduleReconcile(c_key)
+    return True
+
+
+def availableSeats(conf):
+    """Return the live free-seat count of conf, for display."""
+    if not conf.seatShards:
+        return conf.seatsAvailable
+    wsck = conf.key.urlsafe()
+    total = memcache.get(MEMCACHE_SEATS_PREFIX + wsck)
+    if total is None:
+        total = sum(shard.seats for shard in
+                    ndb.get_multi(shardKeys(conf.key, conf.seatShards)) if shard)
+        memcache.add(MEMCACHE_SEATS_PREFIX + wsck, total, time=SEATS_CACHE_TTL)
+    return total
+
+
+def scheduleReconcile(c_key):
+    """Enqueue a reconcile for c_key, at most one per RECONCILE_DELAY."""
+    wsck = c_key.urlsafe()
+    try:
+        taskqueue.add(
+            name='reconcile-seats-%s-%d' % (wsck, time.time() // RECONCILE_DELAY),
+            params={'websafeConferenceKey': wsck},
+            url='/tasks/reconcile_seats',
+            countdown=RECONCILE_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+@transactional()
+def _setSeatsAvailable(c_key, num_shards, total):
+    conf = c_key.get()
+    # the shards were reset (or resized) since they were summed; the
+    # conference's own seatsAvailable is the one to keep
+    if conf.seatShards != num_shards:
+        return conf, conf.seatsAvailable, False
+    if conf.seatsAvailable == total:
+        return conf, total, True
+    old = conf.seatsAvailable
+    conf.seatsAvailable = total
+    conf.put()
+    return conf, old, True
+
+
+def reconcile(c_key):
+    """Write the shard total back to Conference.seatsAvailable.
+
+    Returns (conference, previous seatsAvailable).
+    """
+    conf = c_key.get()
+    if not conf or not conf.seatShards:
+        return conf, conf and conf.seatsAvailable
+    total = sum(shard.seats for shard in
+                ndb.get_multi(shardKeys(c_key, conf.seatShards)) if shard)
+    conf, old, current = _setSeatsAvailable(c_key, conf.seatShards, total)
+    if current:
+        memcache.set(MEMCACHE_SEATS_PREFIX + c_key.urlsafe(), total,
+                     time=SEATS_CACHE_TTL)
+    return conf, old
@@ -16,3 +16,11 @@ WEB_CLIENT_ID = '598704955401-k1ifc40lt3g7svs9auj5h12iskh12c3p.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Verify Google ID tokens in-process against cached signing keys instead
+# of calling the tokeninfo service; access tokens still go to tokeninfo.
+VERIFY_ID_TOKENS_LOCALLY = True
+
+# Fraction of ConferenceApi calls logged as "trace" lines for replay by
+# benchmarks/trace_replay.py; 0 turns recording off.
+TRACE_SAMPLE_RATE = 0
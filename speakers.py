@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""speakers.py
+
+Udacity conference server-side Python App Engine speaker directory
+
+Speaker root entities are keyed by a normalized form of the speaker
+name and hold the keys of that speaker's sessions, so "Dr. Smith" and
+"smith" land on the same entity. Each Speaker also stores its name
+tokens, which makes case-insensitive prefix lookup a single range
+query projected on the matching token, followed by a get_multi for the
+page that is returned.
+
+"""
+
+import re
+from collections import defaultdict
+
+from google.appengine.ext import ndb
+
+from instrumentation import transactional
+from models import Session
+from models import Speaker
+from models import SpeakerCount
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# dropped from names, so "Dr. Jane Smith" and "Jane Smith" are one speaker
+HONORIFICS = frozenset(['dr', 'prof', 'professor', 'mr', 'mrs', 'ms', 'mx',
+                        'sir', 'dame'])
+MAX_TOKEN_LENGTH = 100
+MAX_MATCHING_SPEAKERS = 50
+
+
+def nameTokens(name):
+    """Split a speaker name into case-folded tokens, minus honorifics."""
+    if not name:
+        return []
+    if isinstance(name, str):
+        name = name.decode('utf-8', 'replace')
+    tokens = [t[:MAX_TOKEN_LENGTH] for t in TOKEN_RE.findall(name.lower())]
+    # a name that is nothing but a title keeps it
+    return [t for t in tokens if t not in HONORIFICS] or tokens
+
+
+def speakerId(name):
+    """Return the normalized id of a speaker name."""
+    return ' '.join(nameTokens(name))
+
+
+@transactional()
+def _addSessions(speaker_id, name, session_keys):
+    key = ndb.Key(Speaker, speaker_id)
+    speaker = key.get() or Speaker(key=key, name=name,
+        nameTokens=sorted(set(speaker_id.split())))
+    known = set(speaker.sessionKeys)
+    added = [k for k in session_keys if k not in known]
+    if not added:
+        return speaker
+    speaker.sessionKeys.extend(added)
+    speaker.sessionCount = len(speaker.sessionKeys)
+    speaker.put()
+    return speaker
+
+
+def indexSessions(sessions):
+    """Add sessions to their speakers' entries; safe to repeat."""
+    by_speaker = defaultdict(list)
+    names = {}
+    for session in sessions:
+        speaker_id = speakerId(session.speaker)
+        if not speaker_id:
+            continue
+        by_speaker[speaker_id].append(session.key)
+        names.setdefault(speaker_id, session.speaker)
+    for speaker_id, session_keys in by_speaker.items():
+        _addSessions(speaker_id, names[speaker_id], session_keys)
+
+
+@transactional()
+def recountConference(c_key):
+    """Rebuild a conference's SpeakerCounts from its sessions."""
+    counters = {}
+    for session in Session.query(ancestor=c_key):
+        speaker_id = speakerId(session.speaker)
+        if not speaker_id:
+            continue
+        counter = counters.setdefault(speaker_id, SpeakerCount(
+            key=ndb.Key(SpeakerCount, speaker_id, parent=c_key),
+            speaker=session.speaker, count=0))
+        counter.count += 1
+        counter.sessionNames.append(session.sessionName)
+    wanted = set(counter.key for counter in counters.values())
+    stale = SpeakerCount.query(ancestor=c_key).fetch(keys_only=True)
+    ndb.delete_multi([k for k in stale if k not in wanted])
+    ndb.put_multi(counters.values())
+
+
+def _prefixQuery(tokens):
+    """Return a query matching speakers with a token starting with the
+    longest of tokens.
+    """
+    prefix = max(tokens, key=len)
+    return Speaker.query(Speaker.nameTokens >= prefix,
+                         Speaker.nameTokens < prefix + u'\ufffd') \
+                  .order(Speaker.nameTokens)
+
+
+def _idTokens(speaker_key):
+    speaker_id = speaker_key.id()
+    if isinstance(speaker_id, str):
+        speaker_id = speaker_id.decode('utf-8')
+    return speaker_id.split()
+
+
+def _matches(speaker_key, tokens):
+    """True if every token prefixes some token of the speaker's name."""
+    name_tokens = _idTokens(speaker_key)
+    return all(any(n.startswith(t) for n in name_tokens) for t in tokens)
+
+
+def _firstMatch(row, tokens):
+    """True if a projected _prefixQuery row matches every token and is
+    its speaker's first row, so each speaker is listed once however the
+    pages fall.
+    """
+    prefix = max(tokens, key=len)
+    return _matches(row.key, tokens) and row.nameTokens[0] == min(
+        t for t in _idTokens(row.key) if t.startswith(prefix))
+
+
+def lookup(prefix, page_size, cursor=None):
+    """Return (speakers, next cursor, more) for a page of the directory,
+    narrowed to names matching prefix if it is given.
+
+    Every word of prefix must begin some word of the name, ignoring
+    case and honorifics, so "j smi" finds "Dr. John Smith".
+    """
+    tokens = nameTokens(prefix)
+    if tokens:
+        # one row per speaker token in range, carrying that token
+        rows = _prefixQuery(tokens).iter(start_cursor=cursor,
+            produce_cursors=True, batch_size=page_size,
+            projection=[Speaker.nameTokens])
+    else:
+        rows = Speaker.query().order(Speaker.key).iter(start_cursor=cursor,
+            produce_cursors=True, batch_size=page_size, keys_only=True)
+    # keep reading past rows that don't match until the page is full
+    wanted = []
+    next_cursor, more = None, False
+    for row in rows:
+        if not tokens:
+            wanted.append(row)
+        elif _firstMatch(row, tokens):
+            wanted.append(row.key)
+        if len(wanted) == page_size:
+            next_cursor = rows.cursor_after()
+            more = rows.probably_has_next()
+            break
+    return [s for s in ndb.get_multi(wanted) if s], next_cursor, more
+
+
+def sessionKeys(name):
+    """Return the sorted session keys of every speaker matching name."""
+    tokens = nameTokens(name)
+    if not tokens:
+        return []
+    keys = [k for k in _prefixQuery(tokens).fetch(MAX_MATCHING_SPEAKERS,
+                                                  keys_only=True)
+            if _matches(k, tokens)]
+    session_keys = set()
+    for speaker in ndb.get_multi(list(set(keys))):
+        if speaker:
+            session_keys.update(speaker.sessionKeys)
+    return sorted(session_keys)
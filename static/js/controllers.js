@@ -249,7 +249,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, $q, oauth2Provider, HTTP_ERRORS) {
 
     /**
      * Holds the status if the query is being executed.
@@ -293,6 +293,12 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.conferences = [];
 
+    /**
+     * Holds the token of the next page of the current query, if any.
+     * @type {string}
+     */
+    $scope.nextPageToken = null;
+
     /**
      * Holds the state if offcanvas is enabled.
      *
@@ -390,6 +396,39 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         })
     };
 
+    /**
+     * Autocomplete fields of the filterable fields that have one.
+     */
+    var suggestionFields = {CITY: 'city', TOPIC: 'topics'};
+
+    /**
+     * Invokes the conference.autocomplete API for a filter value being
+     * typed; resolves to the suggested values.
+     *
+     * @param prefix what has been typed so far
+     * @param field the filter's field
+     * @returns {Promise}
+     */
+    $scope.suggestFilterValues = function (prefix, field) {
+        var deferred = $q.defer();
+        var suggestionField = field && suggestionFields[field.enumValue];
+        if (!suggestionField || !prefix || prefix.length < 3) {
+            deferred.resolve([]);
+            return deferred.promise;
+        }
+        gapi.client.conference.autocomplete({prefix: prefix, field: suggestionField}).
+            execute(function (resp) {
+                $scope.$apply(function () {
+                    var values = [];
+                    angular.forEach(resp.items || [], function (suggestion) {
+                        values.push(suggestion.value);
+                    });
+                    deferred.resolve(values);
+                });
+            });
+        return deferred.promise;
+    };
+
     /**
      * Clears all filters.
      */
@@ -423,12 +462,48 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         }
     };
 
+    /**
+     * Appends the next page of the current tab's conferences.
+     */
+    $scope.loadMoreConferences = function () {
+        if (!$scope.nextPageToken) {
+            return;
+        }
+        if ($scope.selectedTab == 'ALL') {
+            $scope.queryConferencesAll(true);
+        } else if ($scope.selectedTab == 'YOU_HAVE_CREATED') {
+            $scope.getConferencesCreated(true);
+        } else if ($scope.selectedTab == 'YOU_WILL_ATTEND') {
+            $scope.getConferencesAttend(true);
+        }
+    };
+
+    /**
+     * Replaces the displayed conferences with resp's page, or appends it
+     * when more is true, and keeps the token of the page after it.
+     */
+    var showConferences = function (resp, more) {
+        if (!more) {
+            $scope.conferences = [];
+            $scope.pagination.currentPage = 0;
+        }
+        angular.forEach(resp.items, function (conference) {
+            $scope.conferences.push(conference);
+        });
+        $scope.nextPageToken = resp.nextPageToken || null;
+    };
+
     /**
      * Invokes the conference.queryConferences API.
+     *
+     * @param more true to append the next page instead of starting over.
      */
-    $scope.queryConferencesAll = function () {
+    $scope.queryConferencesAll = function (more) {
         var sendFilters = {
-            filters: []
+            filters: [],
+            // only what the conference table shows
+            fields: ['websafeKey', 'name', 'city', 'startDate',
+                'organizerDisplayName', 'maxAttendees', 'seatsAvailable']
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
@@ -440,6 +515,9 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                 });
             }
         }
+        if (more) {
+            sendFilters.pageToken = $scope.nextPageToken;
+        }
         $scope.loading = true;
         gapi.client.conference.queryConferences(sendFilters).
             execute(function (resp) {
@@ -458,10 +536,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
-                        angular.forEach(resp.items, function (conference) {
-                            $scope.conferences.push(conference);
-                        });
+                        showConferences(resp, more);
                     }
                     $scope.submitted = true;
                 });
@@ -470,10 +545,13 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
 
     /**
      * Invokes the conference.getConferencesCreated method.
+     *
+     * @param more true to append the next page instead of starting over.
      */
-    $scope.getConferencesCreated = function () {
+    $scope.getConferencesCreated = function (more) {
         $scope.loading = true;
-        gapi.client.conference.getConferencesCreated().
+        gapi.client.conference.getConferencesCreated(
+            more ? {pageToken: $scope.nextPageToken} : {}).
             execute(function (resp) {
                 $scope.$apply(function () {
                     $scope.loading = false;
@@ -495,10 +573,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
-                        angular.forEach(resp.items, function (conference) {
-                            $scope.conferences.push(conference);
-                        });
+                        showConferences(resp, more);
                     }
                     $scope.submitted = true;
                 });
@@ -508,10 +583,13 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     /**
      * Retrieves the conferences to attend by calling the conference.getProfile method and
      * invokes the conference.getConference method n times where n == the number of the conferences to attend.
+     *
+     * @param more true to append the next page instead of starting over.
      */
-    $scope.getConferencesAttend = function () {
+    $scope.getConferencesAttend = function (more) {
         $scope.loading = true;
-        gapi.client.conference.getConferencesToAttend().
+        gapi.client.conference.getConferencesToAttend(
+            more ? {pageToken: $scope.nextPageToken} : {}).
             execute(function (resp) {
                 $scope.$apply(function () {
                     if (resp.error) {
@@ -527,7 +605,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         }
                     } else {
                         // The request has succeeded.
-                        $scope.conferences = resp.result.items;
+                        showConferences(resp.result, more);
                         $scope.loading = false;
                         $scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
                         $scope.alertStatus = 'success';
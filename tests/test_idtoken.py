@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""test_idtoken.py
+
+Unit tests for idtoken.py: tokens are signed with locally generated
+key pairs and the signing keys served by a stub cert endpoint.
+
+Run from the repository root with the App Engine SDK on the path, e.g.
+    GAE_SDK=/path/to/google_appengine python -m unittest discover tests
+
+"""
+
+import base64
+import json
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.environ.get('GAE_SDK'):
+    sys.path.insert(0, os.environ['GAE_SDK'])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+from google.appengine.ext import testbed
+
+import idtoken
+
+
+AUDIENCE = 'client-id.apps.googleusercontent.com'
+NOW = 1500000000
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def _b64int(value):
+    hexed = '%x' % value
+    return _b64(('0' * (len(hexed) % 2) + hexed).decode('hex'))
+
+
+def _jwk(key, kid):
+    return {'kty': 'RSA', 'alg': 'RS256', 'use': 'sig', 'kid': kid,
+            'n': _b64int(key.n), 'e': _b64int(key.e)}
+
+
+def _token(key, kid, **claims):
+    """Sign an ID token with key; claims override the defaults."""
+    payload = {'iss': 'accounts.google.com', 'aud': AUDIENCE,
+               'sub': '1234567890', 'iat': NOW, 'exp': NOW + 3600}
+    payload.update(claims)
+    signed = '%s.%s' % (
+        _b64(json.dumps({'alg': 'RS256', 'kid': kid, 'typ': 'JWT'})),
+        _b64(json.dumps(payload)))
+    signature = PKCS1_v1_5.new(key).sign(SHA256.new(signed))
+    return '%s.%s' % (signed, _b64(signature))
+
+
+class StubResponse(object):
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeClock(object):
+    """Stands in for the time module inside idtoken."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class VerifyIdTokenTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = RSA.generate(1024)
+        cls.other_key = RSA.generate(1024)
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.clock = FakeClock(NOW)
+        self.real_time = idtoken.time
+        idtoken.time = self.clock
+        self.jwks = [_jwk(self.key, 'key-1')]
+        self.fetches = []
+        self.certs = idtoken.CertificateCache(fetch=self._certEndpoint)
+
+    def tearDown(self):
+        idtoken.time = self.real_time
+        self.testbed.deactivate()
+
+    def _certEndpoint(self, url):
+        self.fetches.append(url)
+        return StubResponse(json.dumps({'keys': self.jwks}),
+                            headers={'Cache-Control': 'max-age=3600'})
+
+    def _verify(self, token):
+        return idtoken.verify_id_token(token, [AUDIENCE], certs=self.certs,
+                                       now=self.clock.now)
+
+    def assertRejected(self, token, message):
+        with self.assertRaises(idtoken.InvalidTokenError) as raised:
+            self._verify(token)
+        self.assertIn(message, str(raised.exception))
+
+    def testValidToken(self):
+        claims = self._verify(_token(self.key, 'key-1'))
+        self.assertEqual(claims['sub'], '1234567890')
+        self.assertEqual(len(self.fetches), 1)
+
+    def testBadSignature(self):
+        self.assertRejected(_token(self.other_key, 'key-1'), 'Bad signature')
+
+    def testTamperedPayload(self):
+        header, payload, signature = _token(self.key, 'key-1').split('.')
+        forged = _b64(json.dumps({'iss': 'accounts.google.com',
+            'aud': AUDIENCE, 'sub': 'someone-else', 'iat': NOW,
+            'exp': NOW + 3600}))
+        self.assertRejected('.'.join([header, forged, signature]),
+                            'Bad signature')
+
+    def testMalformedToken(self):
+        self.assertRejected('not.a.jwt', 'Malformed token')
+
+    def testWrongAudience(self):
+        self.assertRejected(_token(self.key, 'key-1', aud='someone-else'),
+                            'Unexpected audience')
+
+    def testWrongIssuer(self):
+        self.assertRejected(_token(self.key, 'key-1', iss='evil.example.com'),
+                            'Unexpected issuer')
+
+    def testExpired(self):
+        self.assertRejected(_token(self.key, 'key-1',
+            iat=NOW - 7200, exp=NOW - 3600), 'Token expired')
+
+    def testExpirySkewBoundary(self):
+        skew = idtoken.CLOCK_SKEW
+        self._verify(_token(self.key, 'key-1', iat=NOW - 3600,
+                            exp=NOW - skew))
+        self.assertRejected(_token(self.key, 'key-1', iat=NOW - 3600,
+                                   exp=NOW - skew - 1), 'Token expired')
+
+    def testIssuedAtSkewBoundary(self):
+        skew = idtoken.CLOCK_SKEW
+        self._verify(_token(self.key, 'key-1', iat=NOW + skew))
+        self.assertRejected(_token(self.key, 'key-1', iat=NOW + skew + 1),
+                            'Token used too early')
+
+    def testUnknownKidRefetchIsThrottled(self):
+        self._verify(_token(self.key, 'key-1'))
+        self.assertEqual(len(self.fetches), 1)
+
+        # the keys rotate; an unknown kid right after a fetch doesn't
+        # refetch, however many tokens name it
+        self.jwks = [_jwk(self.other_key, 'key-2')]
+        for i in range(3):
+            self.assertRejected(_token(self.other_key, 'key-2'),
+                                'Unknown signing key')
+        self.assertEqual(len(self.fetches), 1)
+
+        # once the throttle interval has passed it refetches and finds it
+        self.clock.now += idtoken.MIN_REFRESH_INTERVAL
+        self._verify(_token(self.other_key, 'key-2',
+                            iat=self.clock.now, exp=self.clock.now + 3600))
+        self.assertEqual(len(self.fetches), 2)
+
+    def testUnknownKidAfterRefetch(self):
+        self._verify(_token(self.key, 'key-1'))
+        self.clock.now += idtoken.MIN_REFRESH_INTERVAL
+        self.assertRejected(_token(self.key, 'no-such-key'),
+                            'Unknown signing key')
+        # one forced refetch, then nothing more within the interval
+        self.assertEqual(len(self.fetches), 2)
+        self.assertRejected(_token(self.key, 'no-such-key'),
+                            'Unknown signing key')
+        self.assertEqual(len(self.fetches), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()